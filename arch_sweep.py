@@ -0,0 +1,146 @@
+"""
+Description: Architecture sweep, params / MACs / CPU latency & validation accuracy of model configs
+
+Each config is a named architecture of model.model.ARCHITECTURES with some of its entries replaced
+(stem, blocks, pool, head, mid). With --train_epochs each config is trained with train.py in its own
+directory of --sweep_dir, the accuracy is the one of its last checkpoint on the validation split.
+Latency is measured on the BatchNorm folded model (what the demos run) at each --batch_sizes.
+Configs that no other config beats on both latency (first batch size) and accuracy are the Pareto front.
+
+configs json: [{"name": "xception_s", "arch": "Mini_Xception", "blocks": [8, 16, 32, 64], "checkpoint": "optional.pth.tar"}, ...]
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import subprocess
+import torch
+
+from model.model import ARCHITECTURES, build_model
+from model.inference import load_model, fuse_model, count_params, count_macs, measure_latency, evaluate_accuracy
+from dataset import create_eval_dataloader
+
+CONFIG_KEYS = ['stem', 'blocks', 'pool', 'head', 'mid']
+
+
+def parse_args():
+    # no abbreviations, --batch_size has to go to train.py & not to --batch_sizes
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--configs', type=str, default='', help='json list of configs (default: the named architectures)')
+    parser.add_argument('--sweep_dir', type=str, default='checkpoint/arch_sweep', help='checkpoints & results of the sweep')
+    parser.add_argument('--train_epochs', type=int, default=0, help='train each config for these epochs with train.py, 0 = only benchmark')
+    parser.add_argument('--datapath', type=str, default='data', help='dataset root, training & validation (FER2013 PrivateTest or ImageFolder Test)')
+    parser.add_argument('--num_classes', type=int, default=7, help='classes of the benchmarked models')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64], help='batch sizes of the latency measurements')
+    parser.add_argument('--runs', type=int, default=50, help='timed forward passes of each latency measurement')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads for the latency measurements')
+    parser.add_argument('--budget_ms', type=float, default=0, help='latency budget at the first batch size, the best config within is reported')
+    # anything else goes to train.py (e.g. --batch_size 64 --resident --age_mode)
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+def load_configs(path):
+    if not path:
+        return [dict(name=arch, arch=arch) for arch in ARCHITECTURES]
+    with open(path) as f:
+        return json.load(f)
+
+def config_args(config):
+    """ train.py arguments of a config """
+    cli = ['--arch', config.get('arch', 'Mini_Xception')]
+    for key in CONFIG_KEYS:
+        if key not in config:
+            continue
+        value = config[key]
+        cli += [f'--{key}'] + ([str(v) for v in value] if isinstance(value, list) else [str(value)])
+    return cli
+
+def train_config(config, args, train_args):
+    """ trains a config with train.py in <sweep_dir>/<name>, returns its last checkpoint """
+    directory = os.path.join(args.sweep_dir, config['name'])
+    os.makedirs(directory, exist_ok=True)
+    train_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+    command = [sys.executable, train_py, *config_args(config), '--epochs', str(args.train_epochs),
+               '--datapath', args.datapath, '--test_datapath', args.datapath, '--savepath', directory,
+               '--tensorboard', os.path.join(directory, 'tensorboard'), '--logdir', os.path.join(directory, 'log'),
+               *train_args]
+    print(' '.join(command))
+    subprocess.run(command, check=True)
+    return last_checkpoint(directory)
+
+def last_checkpoint(directory):
+    checkpoints = glob.glob(os.path.join(directory, '*.pth.tar'))
+    return max(checkpoints, key=os.path.getmtime) if checkpoints else None
+
+def benchmark_config(model, batch_sizes, runs=50):
+    fused = fuse_model(model)
+    return {
+        'params': count_params(model),
+        'macs': count_macs(fused),
+        'latency_ms': {batch_size: measure_latency(fused, batch_size, runs) for batch_size in batch_sizes},
+    }
+
+def pareto_front(results, batch_size):
+    """ names of the results with an accuracy that no other result beats on both latency & accuracy """
+    scored = [r for r in results if r['accuracy'] is not None]
+    front = []
+    for r in scored:
+        dominated = any(o['latency_ms'][batch_size] <= r['latency_ms'][batch_size] and o['accuracy'] >= r['accuracy'] and
+                        (o['latency_ms'][batch_size] < r['latency_ms'][batch_size] or o['accuracy'] > r['accuracy'])
+                        for o in scored)
+        if not dominated:
+            front.append(r['name'])
+    return front
+
+def print_results(results, batch_sizes, front):
+    latencies = ' '.join(f'{"b" + str(b) + " ms":>9s}' for b in batch_sizes)
+    print(f'\n{"config":24s} {"params":>9s} {"MMACs":>8s} {latencies} {"accuracy":>9s}  pareto')
+    for r in sorted(results, key=lambda r: r['latency_ms'][batch_sizes[0]]):
+        latencies = ' '.join(f'{r["latency_ms"][b]:9.2f}' for b in batch_sizes)
+        accuracy = '-' if r['accuracy'] is None else f'{r["accuracy"]*100:.2f} %'
+        print(f'{r["name"]:24s} {r["params"]:9d} {r["macs"]/1e6:8.2f} {latencies} {accuracy:>9s}  {"*" if r["name"] in front else ""}')
+
+def main():
+    args, train_args = parse_args()
+    torch.set_num_threads(args.threads)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+
+    dataloader = None
+    results = []
+    for config in load_configs(args.configs):
+        checkpoint = config.get('checkpoint')
+        if args.train_epochs:
+            checkpoint = train_config(config, args, train_args)
+
+        if checkpoint:
+            model = load_model(checkpoint)
+        else:
+            overrides = {key: config[key] for key in CONFIG_KEYS if key in config}
+            model = build_model(config.get('arch', 'Mini_Xception'), args.num_classes, **overrides).eval()
+
+        result = dict(name=config['name'], config=getattr(model, 'config', None), checkpoint=checkpoint, accuracy=None)
+        result.update(benchmark_config(model, args.batch_sizes, args.runs))
+        if checkpoint:
+            dataloader = dataloader or create_eval_dataloader(args.datapath, batch_size=64)
+            result['accuracy'] = evaluate_accuracy(model, dataloader)
+        results.append(result)
+
+    front = pareto_front(results, args.batch_sizes[0])
+    print_results(results, args.batch_sizes, front)
+
+    if args.budget_ms:
+        within = [r for r in results if r['accuracy'] is not None and r['latency_ms'][args.batch_sizes[0]] <= args.budget_ms]
+        if within:
+            best = max(within, key=lambda r: r['accuracy'])
+            print(f'\nBest config within {args.budget_ms} ms: {best["name"]} ({best["checkpoint"]})')
+        else:
+            print(f'\nNo config within {args.budget_ms} ms')
+
+    path = os.path.join(args.sweep_dir, 'results.json')
+    with open(path, 'w') as f:
+        json.dump({'results': results, 'pareto_front': front}, f, indent=2)
+    print(f'\nSaved results in {path}')
+
+if __name__ == '__main__':
+    main()
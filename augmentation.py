@@ -0,0 +1,148 @@
+"""
+Description: Batched augmentation on collated uint8 tensors
+
+Replaces the per sample PIL transforms (ToPILImage -> RandomHorizontalFlip -> ToTensor, RandomEqualize)
+by vectorized torch ops that run once per batch, on whatever device the batch lives on.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+
+def _histograms(images):
+    """ (N, H*W) uint8 -> (N, 256) int64 histogram of each row, with a single bincount """
+    n = images.shape[0]
+    offsets = torch.arange(n, device=images.device).unsqueeze(1) * 256
+    flat = (images.long() + offsets).reshape(-1)
+    return torch.bincount(flat, minlength=n * 256).reshape(n, 256)
+
+def _apply_lut(images, lut):
+    return torch.gather(lut, 1, images.long()).to(torch.uint8)
+
+def equalize_cv2(images):
+    """
+    Batched cv2.equalizeHist (what utils.histogram_equalization does for FER2013)
+    images: uint8 tensor (..., H, W)
+    """
+    shape = images.shape
+    flat = images.reshape(-1, shape[-2] * shape[-1])
+    total = flat.shape[1]
+    hist = _histograms(flat)
+
+    # count of the first non empty bin, it is mapped to 0
+    first = torch.argmax((hist > 0).int(), dim=1, keepdim=True)
+    first_count = torch.gather(hist, 1, first)
+    # float32 tensor / tensor division, to round exactly like cv2 (scalar / tensor goes through a reciprocal)
+    denominator = (total - first_count).clamp(min=1).float()
+    scale = torch.full_like(denominator, 255.0) / denominator
+    lut = torch.round((torch.cumsum(hist, dim=1) - first_count).float() * scale).clamp(0, 255).long()
+
+    # single valued images are kept as they are
+    constant = first_count == total
+    lut = torch.where(constant, torch.arange(256, device=images.device).expand_as(lut), lut)
+    return _apply_lut(flat, lut).reshape(shape)
+
+def equalize_pil(images):
+    """
+    Batched PIL ImageOps.equalize (what transforms.RandomEqualize does for the ImageFolder datasets)
+    images: uint8 tensor (..., H, W)
+    """
+    shape = images.shape
+    flat = images.reshape(-1, shape[-2] * shape[-1])
+    total = flat.shape[1]
+    hist = _histograms(flat)
+
+    # count of the last non empty bin is excluded from the step
+    last = 255 - torch.argmax((hist.flip(1) > 0).int(), dim=1, keepdim=True)
+    step = (total - torch.gather(hist, 1, last)) // 255
+    lut = (torch.cumsum(hist, dim=1) - hist + step // 2) // step.clamp(min=1)
+    lut = lut.clamp(max=255)
+
+    identity = torch.arange(256, device=images.device).expand_as(lut)
+    lut = torch.where(step == 0, identity, lut)
+    return _apply_lut(flat, lut).reshape(shape)
+
+EQUALIZERS = {'cv2': equalize_cv2, 'pil': equalize_pil}
+
+
+class BatchAugmentation:
+    """
+    Augmentation of a whole batch after collation
+        equalize: None, 'cv2' (FER2013) or 'pil' (ImageFolder) histogram equalization
+        flip: probability of horizontal flip
+        rotation: max rotation angle in degrees, sampled as utils.random_rotation does (0 = off)
+        crop: random crop size that is resized back to the input size (0 = off)
+
+    Takes uint8 images (B, H, W) or (B, C, H, W) and returns float images (B, C, H, W) in [0,1]
+    like ToTensor. The random ops are disabled in eval mode.
+    """
+    def __init__(self, equalize=None, flip=0.5, rotation=0, crop=0):
+        assert equalize in [None, 'cv2', 'pil']
+        self.equalize = equalize
+        self.flip = flip
+        self.rotation = rotation
+        self.crop = crop
+        self.training = True
+
+    def train(self, mode=True):
+        self.training = mode
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def __call__(self, images):
+        if images.dim() == 3:
+            images = images.unsqueeze(1)
+
+        if self.equalize:
+            images = EQUALIZERS[self.equalize](images)
+        images = images.float() / 255
+
+        if not self.training:
+            return images
+
+        if self.rotation or self.crop:
+            images = self.random_affine(images)
+
+        if self.flip > 0:
+            flip = torch.rand(images.shape[0], device=images.device) < self.flip
+            images = torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+
+        return images
+
+    def random_affine(self, images):
+        """ rotation followed by random crop & resize, as one grid_sample over the batch """
+        batch, _, h, w = images.shape
+        device = images.device
+        theta = torch.zeros(batch, 2, 3, device=device)
+
+        # crop in normalized coordinates (align_corners=False): scale & translation of the output grid
+        scale_x = scale_y = torch.ones(batch, device=device)
+        shift_x = shift_y = torch.zeros(batch, device=device)
+        if self.crop:
+            offset_x = torch.randint(0, w - self.crop + 1, (batch,), device=device).float()
+            offset_y = torch.randint(0, h - self.crop + 1, (batch,), device=device).float()
+            scale_x = scale_x * self.crop / w
+            scale_y = scale_y * self.crop / h
+            shift_x = (2 * offset_x + self.crop) / w - 1
+            shift_y = (2 * offset_y + self.crop) / h - 1
+
+        # integer angles in [-rotation, rotation) like np.random.randint in utils.random_rotation,
+        # positive angles rotate counter clockwise as cv2.getRotationMatrix2D
+        angle = torch.zeros(batch, device=device)
+        if self.rotation:
+            angle = torch.randint(-self.rotation, self.rotation, (batch,), device=device).float()
+        angle = angle * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # sampling grid = inverse rotation (in pixel units, hence the aspect ratio terms) of the crop grid
+        theta[:, 0, 0] = cos * scale_x
+        theta[:, 0, 1] = -sin * scale_y * h / w
+        theta[:, 0, 2] = cos * shift_x - sin * shift_y * h / w
+        theta[:, 1, 0] = sin * scale_x * w / h
+        theta[:, 1, 1] = cos * scale_y
+        theta[:, 1, 2] = sin * shift_x * w / h + cos * shift_y
+
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
@@ -17,27 +17,35 @@ from torch.functional import norm
 import torchvision.transforms.transforms as transforms
 from face_detector.face_detector import DnnDetector, HaarCascadeDetector
 
-from model.model import Mini_Xception
+from model.inference import load_model, compile_model, BACKENDS
+from mixed_precision import AMP_MODES, check_amp, autocast
+from model.quantization import load_int8, int8_path
 from utils import get_label_emotion, normalization, histogram_equalization, standerlization, get_label_age
 from face_alignment.face_alignment import FaceAlignment
+from profiling import NullProfiler, create_profiler
+from torch.profiler import record_function
 
 sys.path.insert(1, 'face_detector')
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 def main(args):
-    # Model
-    mini_xception = Mini_Xception().to(device)
-    mini_xception.eval()
-
-    mini_xception_age = Mini_Xception(5).to(device)
-    mini_xception_age.eval()
-
-    # Load model
-    checkpoint = torch.load(args.pretrained, map_location=device)
-    checkpoint_age = torch.load(args.pretrained_age, map_location=device)
-
-    mini_xception.load_state_dict(checkpoint['mini_xception'])
-    mini_xception_age.load_state_dict(checkpoint_age['mini_xception'])
+    check_amp(args.amp, device)
+    # Model (training checkpoints or BatchNorm folded ones from export.py)
+    # --multi_head: a single Mini_Xception_MultiHead checkpoint (train.py --joint) gives emotion & age
+    mini_xception_age = None
+    if args.int8:
+        # int8 TorchScript models saved by quantize.py / train.py --qat next to the checkpoints
+        mini_xception = load_int8(int8_path(args.pretrained))
+        if not args.multi_head:
+            mini_xception_age = load_int8(int8_path(args.pretrained_age))
+    elif args.multi_head:
+        mini_xception = load_model(args.pretrained, 'Mini_Xception_MultiHead', device=device)
+        mini_xception = compile_model(mini_xception, args.pretrained, args.compile, args.channels_last, device)
+    else:
+        mini_xception = load_model(args.pretrained, num_classes=7, device=device)
+        mini_xception_age = load_model(args.pretrained_age, num_classes=5, device=device)
+        mini_xception = compile_model(mini_xception, args.pretrained, args.compile, args.channels_last, device)
+        mini_xception_age = compile_model(mini_xception_age, args.pretrained_age, args.compile, args.channels_last, device)
 
     face_alignment = FaceAlignment()
 
@@ -62,93 +70,106 @@ def main(args):
     t1 = 0
     t2 = 0
     
-    while args.image or isOpened:
-        if args.image:
-            frame = cv2.imread(args.path)
-        else:
-            _, frame = video.read()
-            isOpened = video.isOpened()    
-        # if loaded video or image (not live camera) .. resize it 
-        if args.path:
-            frame = cv2.resize(frame, (640, 480))
-
-        # time
-        t2 = time.time()
-        fps = round(1/(t2-t1))
-        t1 = t2
-
-        # faces
-        faces = face_detector.detect_faces(frame)
-
-        for face in faces:
-            (x,y,w,h) = face
-
-            # preprocessing
-            input_face = face_alignment.frontalize_face(face, frame)
-            input_face = cv2.resize(input_face, (48,48))
-
-            input_face = histogram_equalization(input_face)
-            cv2.imshow('input face', cv2.resize(input_face, (120, 120)))
-
-            input_face = transforms.ToTensor()(input_face).to(device)
-            input_face = torch.unsqueeze(input_face, 0)
-
-            with torch.no_grad():
-                input_face = input_face.to(device)
-                t = time.time()
-                emotion = mini_xception(input_face)
-                age = mini_xception_age(input_face)
-
-                # print(f'\ntime={(time.time()-t) * 1000 } ms')
-
-                torch.set_printoptions(precision=6)
-                softmax = torch.nn.Softmax()
-
-                emotions_soft = softmax(emotion.squeeze()).reshape(-1,1).cpu().detach().numpy()
-                emotions_soft = np.round(emotions_soft, 3)
-
-                ages_soft = softmax(emotion.squeeze()).reshape(-1,1).cpu().detach().numpy()
-                ages_soft = np.round(emotions_soft, 3)
-
-                for i, em in enumerate(emotions_soft):
-                    em = round(em.item(),3)
-                    # print(f'{get_label_emotion(i)} : {em}')
-
-                for i, ag in enumerate(ages_soft):
-                    ag = round(ag.item(), 3)
-                    # print(f'{get_label_emotion(i)} : {em}')
-
-                emotion = torch.argmax(emotion)
-                age = torch.argmax(age)
-
-                percentage = round(emotions_soft[emotion].item(), 2)
-                percentage_age = round(ages_soft[age].item(), 2)
-
-                emotion = emotion.squeeze().cpu().detach().item()
-                age = age.squeeze().cpu().detach().item()
-
-                emotion = get_label_emotion(emotion)
-                age = get_label_age(age)
-
-                # draw emotion info
-                frame[y-60:y, x:x+w] = (50,50,50)
-                cv2.putText(frame, emotion, (x,y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,200,200))
-                cv2.putText(frame, str(percentage), (x + w - 40,y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-                            (200,200,0))
-
-                # draw age info
-                cv2.putText(frame, age, (x, y - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 200, 200))
-                cv2.putText(frame, str(percentage_age), (x + w - 40, y - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-                            (200, 200, 0))
-
-                # enclose face
-                cv2.rectangle(frame, (x,y), (x+w, y+h), (255,0,0), 3)
+    # --profile: window of the first frames, a no-op otherwise
+    profiler = NullProfiler()
+    if args.profile:
+        profiler = create_profiler(args.tensorboard, 'camera_demo', args.profile_wait, args.profile_warmup, args.profile_steps, args.profile_top)
+    with profiler:
+        while args.image or isOpened:
+            if args.image:
+                frame = cv2.imread(args.path)
+            else:
+                _, frame = video.read()
+                isOpened = video.isOpened()    
+            # if loaded video or image (not live camera) .. resize it 
+            if args.path:
+                frame = cv2.resize(frame, (640, 480))
+
+            # time
+            t2 = time.time()
+            fps = round(1/(t2-t1))
+            t1 = t2
+
+            # faces
+            with record_function('face_detection'):
+                faces = face_detector.detect_faces(frame)
+
+            for face in faces:
+                (x,y,w,h) = face
+
+                # preprocessing
+                with record_function('preprocessing'):
+                    input_face = face_alignment.frontalize_face(face, frame)
+                    input_face = cv2.resize(input_face, (48,48))
+
+                    input_face = histogram_equalization(input_face)
+                cv2.imshow('input face', cv2.resize(input_face, (120, 120)))
+
+                input_face = transforms.ToTensor()(input_face).to(device)
+                input_face = torch.unsqueeze(input_face, 0)
+
+                with torch.no_grad():
+                    input_face = input_face.to(device)
+                    t = time.time()
+                    with autocast(args.amp, device), record_function('model'):
+                        if args.multi_head:
+                            emotion, age = mini_xception(input_face)
+                        else:
+                            emotion = mini_xception(input_face)
+                            age = mini_xception_age(input_face)
+                    emotion, age = emotion.float(), age.float()
+
+                    # print(f'\ntime={(time.time()-t) * 1000 } ms')
+
+                    torch.set_printoptions(precision=6)
+                    softmax = torch.nn.Softmax()
+
+                    emotions_soft = softmax(emotion.squeeze()).reshape(-1,1).cpu().detach().numpy()
+                    emotions_soft = np.round(emotions_soft, 3)
+
+                    ages_soft = softmax(age.squeeze()).reshape(-1,1).cpu().detach().numpy()
+                    ages_soft = np.round(ages_soft, 3)
+
+                    for i, em in enumerate(emotions_soft):
+                        em = round(em.item(),3)
+                        # print(f'{get_label_emotion(i)} : {em}')
+
+                    for i, ag in enumerate(ages_soft):
+                        ag = round(ag.item(), 3)
+                        # print(f'{get_label_emotion(i)} : {em}')
+
+                    emotion = torch.argmax(emotion)
+                    age = torch.argmax(age)
+
+                    percentage = round(emotions_soft[emotion].item(), 2)
+                    percentage_age = round(ages_soft[age].item(), 2)
+
+                    emotion = emotion.squeeze().cpu().detach().item()
+                    age = age.squeeze().cpu().detach().item()
+
+                    emotion = get_label_emotion(emotion)
+                    age = get_label_age(age)
+
+                    # draw emotion info
+                    frame[y-60:y, x:x+w] = (50,50,50)
+                    cv2.putText(frame, emotion, (x,y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,200,200))
+                    cv2.putText(frame, str(percentage), (x + w - 40,y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                                (200,200,0))
+
+                    # draw age info
+                    cv2.putText(frame, age, (x, y - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 200, 200))
+                    cv2.putText(frame, str(percentage_age), (x + w - 40, y - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                                (200, 200, 0))
+
+                    # enclose face
+                    cv2.rectangle(frame, (x,y), (x+w, y+h), (255,0,0), 3)
     
-        cv2.putText(frame, str(fps), (10,25), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0))
-        cv2.imshow("Video", frame)   
-        if cv2.waitKey(1) & 0xff == 27:
-            video.release()
-            break
+            cv2.putText(frame, str(fps), (10,25), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0))
+            cv2.imshow("Video", frame)   
+            profiler.step()
+            if cv2.waitKey(1) & 0xff == 27:
+                video.release()
+                break
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -160,7 +181,21 @@ if __name__ == '__main__':
     parser.add_argument('--head_pose', action='store_true', help='visualization of head pose euler angles')
     parser.add_argument('--path', type=str, default='', help='path to video to test')
     parser.add_argument('--image', action='store_true', help='specify if you test image or not')
+    parser.add_argument('--compile', type=str, default='eager', choices=BACKENDS, help='eager model, TorchScript (cached next to the checkpoint) or torch.compile')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory layout')
+    parser.add_argument('--amp', type=str, default='', choices=AMP_MODES, help='mixed precision inference, bf16 (CPU & recent GPUs) or fp16 (GPU)')
+    parser.add_argument('--multi_head', action='store_true', help='--pretrained is a shared backbone emotion + age checkpoint (train.py --joint)')
+    parser.add_argument('--int8', action='store_true', help='run the int8 models (<checkpoint>.int8.ts from quantize.py), CPU only')
+    parser.add_argument('--profile', action='store_true', help='torch.profiler window of the first frames (see profiling.py)')
+    parser.add_argument('--profile_wait', type=int, default=5, help='frames skipped before the --profile window (camera & model warmup)')
+    parser.add_argument('--profile_warmup', type=int, default=2, help='warmup frames of the --profile window, not recorded')
+    parser.add_argument('--profile_steps', type=int, default=20, help='frames recorded by --profile')
+    parser.add_argument('--profile_top', type=int, default=15, help='operators of the printed --profile summary')
+    parser.add_argument('--tensorboard', type=str, default='checkpoint/tensorboard', help='log dir of the --profile traces')
     args = parser.parse_args()
+    # quantized kernels only run on CPU
+    if args.int8:
+        device = torch.device('cpu')
 
     main(args)
 
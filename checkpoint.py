@@ -0,0 +1,143 @@
+"""
+Description: Checkpoint manager of train.py, background & atomic writes with retention
+
+save() copies the state to CPU (the training continues on the live tensors) & a background
+thread writes it to <path>.tmp before renaming it, so a preempted run never leaves a truncated
+checkpoint. Only the last --keep_last & the best --keep_best (validation accuracy) checkpoints of
+the run are kept, with their companion files (int8 models, compiled caches). The kept ones are
+listed in the index json next to them, so the retention goes on after --resume.
+"""
+import os
+import re
+import json
+import queue
+import shutil
+import random
+import threading
+import numpy as np
+import torch
+
+from model.quantization import int8_path
+
+# <checkpoint>.<model class>.<checkpoint hash>.<device>[.channels_last].ts of model.inference.compiled_cache_path
+SCRIPT_CACHE = r'\.[A-Za-z_]\w*\.[0-9a-f]{16}\.\w+(\.channels_last)?\.ts$'
+
+
+def to_cpu(state):
+    """ copy of a (nested) state with every tensor detached & copied to CPU """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+def rng_state():
+    """ torch, cuda, numpy & python random generators, what makes a resumed run shuffle & augment the same """
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+    }
+
+def set_rng_state(state):
+    # the generator states have to be CPU byte tensors, whatever map_location loaded them to
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda.cpu() for cuda in state['cuda']])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+def companion_paths(path):
+    """ int8 model (--qat, quantize.py), TorchScript & inductor caches (test.py, the demos) written next to a checkpoint """
+    base = path[:-len('.pth.tar')] if path.endswith('.pth.tar') else path
+    # the exact names only, the checkpoints of the other runs in the same --savepath can start with base too
+    script_cache = re.compile(re.escape(os.path.basename(base)) + SCRIPT_CACHE)
+    directory = os.path.dirname(path) or '.'
+    scripts = [os.path.join(directory, name) for name in os.listdir(directory) if script_cache.match(name)]
+    return [int8_path(path), base + '.inductor'] + scripts
+
+def atomic_save(state, path):
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+    """
+    keep_last: checkpoints of the last epochs kept, keep_best: best ones by score kept (0 = none)
+    index: json of the kept checkpoints of this run (epoch, score)
+    """
+    def __init__(self, index, keep_last=3, keep_best=3):
+        self.index = index
+        # the checkpoint just written is always kept
+        self.keep_last = max(1, keep_last)
+        self.keep_best = keep_best
+        self.checkpoints = []
+        if os.path.isfile(index):
+            with open(index) as f:
+                self.checkpoints = [c for c in json.load(f) if os.path.isfile(c['path'])]
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, epoch, score=None):
+        """ queues the checkpoint, blocks only while the previous one is still being written """
+        self._raise()
+        self.queue.put((to_cpu(state), path, epoch, score))
+
+    def wait(self):
+        """ returns once every queued checkpoint is on disk """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint write failed') from error
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                state, path, epoch, score = job
+                atomic_save(state, path)
+                self.checkpoints = [c for c in self.checkpoints if c['path'] != path]
+                self.checkpoints.append(dict(path=path, epoch=epoch, score=score))
+                self._retain()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _retain(self):
+        """ removes the checkpoints that are neither in the last keep_last nor in the best keep_best """
+        by_epoch = sorted(self.checkpoints, key=lambda c: c['epoch'], reverse=True)
+        scored = [c for c in self.checkpoints if c['score'] is not None]
+        by_score = sorted(scored, key=lambda c: (c['score'], c['epoch']), reverse=True)
+        keep = {c['path'] for c in by_epoch[:self.keep_last]} | {c['path'] for c in by_score[:self.keep_best]}
+
+        for c in self.checkpoints:
+            if c['path'] not in keep:
+                # the int8 model / compiled caches of the checkpoint go with it
+                for path in [c['path']] + companion_paths(c['path']):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.isfile(path):
+                        os.remove(path)
+        self.checkpoints = [c for c in by_epoch if c['path'] in keep]
+
+        tmp = self.index + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.checkpoints, f, indent=2)
+        os.replace(tmp, self.index)
@@ -0,0 +1,156 @@
+"""
+Description: Compare training runs, table or plots of the JSONL metrics logs (& the older text logs)
+
+    python compare_runs.py checkpoint/logging_*.jsonl
+    python compare_runs.py checkpoint/logging_*.jsonl custom_logs/* --filter batch_size=64 lr=0.001,0.0001 --sort accuracy
+    python compare_runs.py checkpoint/logging_*.jsonl --plot accuracy val_loss lr --save runs.png
+
+The table has the hyperparameters that differ between the runs, the best --sort metric & its epoch,
+the last epoch & the training speed. --filter keeps the runs whose train.py arguments match every
+key=value (comma separated values = any of them).
+"""
+import os
+import glob
+import argparse
+
+from metrics_log import load_run
+
+# the lower the better, the other metrics are maximized
+LOWER_IS_BETTER = ['train_loss', 'val_loss', 'epoch_time', 'wall_time']
+# output paths of the runs, not hyperparameters
+PATH_ARGS = ['savepath', 'tensorboard', 'logdir', 'logging', 'pretrained', 'teacher_cache']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('runs', type=str, nargs='+', help='metrics logs (.jsonl) or text logs of train.py, globs too')
+    parser.add_argument('--filter', type=str, nargs='*', default=[], help='key=value[,value] train.py arguments the runs must have')
+    parser.add_argument('--sort', type=str, default='accuracy', help='metric whose best value ranks the runs')
+    parser.add_argument('--top', type=int, default=0, help='only the best runs, 0 = all')
+    parser.add_argument('--plot', type=str, nargs='*', default=None, help='plot these metrics of each epoch (default: accuracy & val_loss)')
+    parser.add_argument('--save', type=str, default='', help='save the plot to this file instead of showing it')
+    return parser.parse_args()
+
+def find_logs(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        paths += [path for path in matches if os.path.isfile(path) and path not in paths]
+    return paths
+
+def parse_filters(filters):
+    """ {key: [values]} of the key=value[,value] filters """
+    parsed = {}
+    for item in filters:
+        key, _, values = item.partition('=')
+        if not values:
+            raise ValueError(f'--filter {item}: expected key=value')
+        parsed[key] = values.split(',')
+    return parsed
+
+def same_value(value, expected):
+    """ an argument value of a run against a --filter string, numbers compared as numbers """
+    if isinstance(value, bool) or value is None:
+        return str(value).lower() == expected.lower()
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value) == expected.replace(',', ' ')
+    try:
+        return float(value) == float(expected)
+    except (TypeError, ValueError):
+        return str(value) == expected
+
+def matches(run, filters):
+    return all(key in run['args'] and any(same_value(run['args'][key], value) for value in values)
+               for key, values in filters.items())
+
+def best_epoch(run, metric):
+    """ epoch metrics of the best value of metric, None if the run never logged it """
+    epochs = [epoch for epoch in run['epochs'] if epoch.get(metric) is not None]
+    if not epochs:
+        return None
+    best = min if metric in LOWER_IS_BETTER else max
+    return best(epochs, key=lambda epoch: epoch[metric])
+
+def varying_args(runs):
+    """ arguments that are not the same in every run that has them (not the text logs), the columns of the table """
+    keys = sorted(set(key for run in runs for key in run['args']) - set(PATH_ARGS))
+    varying = []
+    for key in keys:
+        values = set(repr(run['args'][key]) for run in runs if key in run['args'])
+        if len(values) > 1:
+            varying.append(key)
+    return varying
+
+def format_value(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value)
+    return '' if value is None else str(value)
+
+def print_table(runs, metric):
+    keys = varying_args(runs)
+    columns = ['run'] + keys + [f'best {metric}', 'epoch', 'epochs', 'samples/s', 'time (s)']
+    rows = []
+    for run in runs:
+        best = best_epoch(run, metric)
+        last = run['epochs'][-1] if run['epochs'] else {}
+        speeds = [epoch['train_samples_per_sec'] for epoch in run['epochs'] if 'train_samples_per_sec' in epoch]
+        rows.append([run['name']] + [format_value(run['args'].get(key)) for key in keys] + [
+            format_value(best[metric]) if best else '-',
+            str(best['epoch']) if best else '-',
+            str(len(run['epochs'])),
+            f'{sum(speeds) / len(speeds):.1f}' if speeds else '-',
+            f'{last["wall_time"]:.0f}' if 'wall_time' in last else '-',
+        ])
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+def plot_runs(runs, metrics, save=''):
+    import matplotlib
+    if save:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(1, len(metrics), figsize=(6 * len(metrics), 4.5), squeeze=False)
+    for axis, metric in zip(axes[0], metrics):
+        for run in runs:
+            epochs = [epoch for epoch in run['epochs'] if epoch.get(metric) is not None]
+            axis.plot([epoch['epoch'] for epoch in epochs], [epoch[metric] for epoch in epochs], label=run['name'])
+        axis.set_xlabel('Epoch')
+        axis.set_ylabel(metric)
+        axis.grid()
+    axes[0][0].legend(fontsize='small')
+    figure.tight_layout()
+    if save:
+        figure.savefig(save)
+        print(f'Saved plot in {save}')
+    else:
+        plt.show()
+
+def main():
+    args = parse_args()
+    filters = parse_filters(args.filter)
+    runs = [load_run(path) for path in find_logs(args.runs)]
+    runs = [run for run in runs if matches(run, filters)]
+    if not runs:
+        print('no run matches')
+        return
+
+    def score(run):
+        best = best_epoch(run, args.sort)
+        if best is None:
+            return float('inf')
+        return best[args.sort] if args.sort in LOWER_IS_BETTER else -best[args.sort]
+    runs.sort(key=score)
+    if args.top:
+        runs = runs[:args.top]
+
+    print_table(runs, args.sort)
+    if args.plot is not None:
+        plot_runs(runs, args.plot or ['accuracy', 'val_loss'], args.save)
+
+if __name__ == '__main__':
+    main()
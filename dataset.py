@@ -5,15 +5,23 @@ email: amrelsersay@gmail.com
 Description: FER2013 dataset
 """
 import argparse
+import bisect
 import cv2
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Subset, Sampler
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
 import torchvision.transforms.transforms as transforms
 import pandas as pd
 import os
 import numpy as np
 import torch
+import torch.distributed as dist
+
+from torchvision import datasets
 
 from utils import get_label_emotion, normalization, histogram_equalization, standerlization, normalize_dataset_mode_1, normalize_dataset_mode_255, get_transforms
+from utils import pil_histogram_equalization
+from datastore import open_fer2013_store, decode_fer2013_pixels, open_image_folder_store, ensure_image_folder_store, shard_name
 
 class FER2013(Dataset):
     """
@@ -24,14 +32,25 @@ class FER2013(Dataset):
     emotion: label (from 0 - 6)
     pixels: 48x48 pixel value (uint8)
     Usage: [Training, PrivateTest, PublicTest]    
+
+    If the csv was converted with datastore.py, the memory-mapped store is used instead
+    and no pixel strings are parsed at all. When the store was built with baked equalization,
+    equalized is True and faces are not equalized again.
     """
-    def __init__(self, root='/data', mode = 'train', transform = None):
+    def __init__(self, root='/data', mode = 'train', transform = None, use_store = True):
         
         self.root = root
         self.transform = transform
         assert mode in ['train', 'val', 'test']
         self.mode = mode
 
+        self.store = open_fer2013_store(root) if use_store else None
+        self.equalized = False
+        if self.store is not None:
+            self.index = np.array(self.store[f'{mode}_index'])
+            self.equalized = self.store.meta['preprocess']['equalize'] is not None
+            return
+
         self.csv_path = os.path.join(self.root, 'fer2013.csv')
         self.df = pd.read_csv(self.csv_path)
         # print(self.df)
@@ -44,57 +63,357 @@ class FER2013(Dataset):
             self.df = self.df[self.df['Usage'] == 'PublicTest']
 
     def __getitem__(self, index: int):
-        data_series = self.df.iloc[index]
-        emotion = data_series['emotion']
-        pixels  = data_series['pixels']
+        if self.store is not None:
+            i = self.index[index]
+            # copy the slice out of the read only memory map
+            face = np.array(self.store['faces'][i])
+            emotion = self.store['labels'][i]
+        else:
+            data_series = self.df.iloc[index]
+            emotion = data_series['emotion']
+            pixels  = data_series['pixels']
 
-        # to numpy
-        face = list(map(int, pixels.split(' ')))
-        face = np.array(face).reshape(48,48).astype(np.uint8)
+            # to numpy
+            face = list(map(int, pixels.split(' ')))
+            face = np.array(face).reshape(48,48).astype(np.uint8)
 
         if self.transform:
-            face = histogram_equalization(face)
+            if not self.equalized:
+                face = histogram_equalization(face)
             # face = normalization(face)
             face = self.transform(face)
 
         return face, emotion
 
     def __len__(self) -> int:
+        if self.store is not None:
+            return len(self.index)
         return self.df.index.size
 
 
-def create_train_dataloader(root='../data', batch_size=64):
-    dataset = FER2013(root, mode='train', transform=get_transforms())
-    dataloader = DataLoader(dataset, batch_size, shuffle=True)
+class PackedImageFolder(Dataset):
+    """
+    ImageFolder dataset packed into uint8 shards by datastore.py (--image_folder)
+    samples are grayscale (size, size) uint8 faces. Faces are equalized at load time like
+    the ImageFolder transform, unless equalization was baked into the store (equalized).
+    """
+    def __init__(self, store, transform = None):
+        self.store = store
+        self.transform = transform
+        self.classes = store.meta['classes']
+        self.class_to_idx = store.meta['class_to_idx']
+        self.equalized = store.meta['preprocess']['equalize'] is not None
+        # global index of the first face of each shard
+        self.offsets = np.cumsum([0] + store.meta['shards'])
+
+    def __getitem__(self, index: int):
+        shard = np.searchsorted(self.offsets, index, side='right') - 1
+        face = np.array(self.store[shard_name(shard)][index - self.offsets[shard]])
+        label = self.store['labels'][index]
+
+        if self.transform:
+            if not self.equalized:
+                face = pil_histogram_equalization(face)
+            face = self.transform(face)
+        return face, label
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def faces(self, start=0, stop=None):
+        """ faces [start, stop) in one (n, size, size) array, all of them by default """
+        stop = len(self) if stop is None else stop
+        chunks = []
+        for shard in range(len(self.offsets) - 1):
+            begin, end = max(start, self.offsets[shard]), min(stop, self.offsets[shard + 1])
+            if begin < end:
+                chunks.append(self.store[shard_name(shard)][begin - self.offsets[shard]: end - self.offsets[shard]])
+        if not chunks:
+            return np.empty((0,) + tuple(self.store.meta['shape']), dtype=np.uint8)
+        return np.concatenate(chunks)
+
+
+def create_image_folder_dataset(folder, transform=None, store_transform=None, preprocess=False):
+    """
+    Dataset of an ImageFolder root: its packed store when there is one (built / rebuilt with baked
+    equalization if preprocess), otherwise torchvision ImageFolder with the per sample transform
+    """
+    if preprocess:
+        store = ensure_image_folder_store(folder, equalize='pil')
+    else:
+        store = open_image_folder_store(folder)
+
+    if store is None:
+        return datasets.ImageFolder(folder, transform=transform)
+    return PackedImageFolder(store, transform=store_transform)
+
+
+class MultiTaskDataset(ConcatDataset):
+    """
+    Concatenation of single task datasets (e.g. FER2013 emotions & ImageFolder ages) for the
+    multi head model, task i is the label of the i-th dataset. The label of a sample is a
+    (num_tasks,) int64 array with -1 for the tasks its dataset has no label for.
+    """
+    def __init__(self, datasets):
+        super(MultiTaskDataset, self).__init__(datasets)
+        self.num_tasks = len(self.datasets)
+
+    def __getitem__(self, index: int):
+        task = bisect.bisect_right(self.cumulative_sizes, index)
+        face, label = super(MultiTaskDataset, self).__getitem__(index)
+        labels = np.full(self.num_tasks, -1, dtype=np.int64)
+        labels[task] = label
+        return face, labels
+
+
+class DistillationDataset(Dataset):
+    """
+    Dataset with the cached teacher logits of each sample (see distillation.py),
+    the label of a sample is (label, teacher logits (num_classes,) float32)
+    """
+    def __init__(self, dataset, logits):
+        assert len(dataset) == len(logits)
+        self.dataset = dataset
+        self.logits = logits
+
+    def __getitem__(self, index: int):
+        face, label = self.dataset[index]
+        return face, (label, np.asarray(self.logits[index], dtype=np.float32))
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+class ResidentLoader:
+    """
+    Keeps a whole dataset in one contiguous uint8 tensor (on the training device) and yields
+    (images, labels) mini-batches by index permutation, skipping Dataset.__getitem__ & collate.
+    Images are raw uint8 (B, 1, H, W), to be augmented with augmentation.BatchAugmentation.
+    Labels of a DistillationDataset are (labels, teacher logits) like in its DataLoader.
+    world_size > 1: yields the rank's shard only, split like a DistributedSampler (padded to a
+    multiple of world_size, same permutation on every rank for an epoch, see set_epoch), or
+    like a ShardSampler without pad (evaluation, every sample once)
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, device='cpu', drop_last=False, rank=0, world_size=1, seed=0, pad=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+        faces, labels = load_resident(dataset)
+        self.images = torch.from_numpy(faces).unsqueeze(1).to(device)
+        self.labels = torch.from_numpy(labels).to(device)
+        self.logits = None
+        if isinstance(dataset, DistillationDataset):
+            self.logits = torch.from_numpy(np.asarray(dataset.logits, dtype=np.float32)).to(device)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_samples(self):
+        """ samples of this rank """
+        n = self.labels.shape[0]
+        if self.world_size == 1:
+            return n
+        if not self.pad:
+            return len(range(self.rank, n, self.world_size))
+        if self.drop_last:
+            return n // self.world_size
+        return (n + self.world_size - 1) // self.world_size
+
+    def __len__(self) -> int:
+        n = self.num_samples()
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = self.labels.shape[0]
+        if self.shuffle and self.world_size > 1:
+            # the ranks have to agree on the permutation to get disjoint shards
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=generator).to(self.labels.device)
+        elif self.shuffle:
+            order = torch.randperm(n, device=self.labels.device)
+        else:
+            order = torch.arange(n, device=self.labels.device)
+
+        if self.world_size > 1 and not self.pad:
+            order = order[self.rank:: self.world_size]
+        elif self.world_size > 1:
+            total = self.num_samples() * self.world_size
+            if total > n:
+                order = torch.cat([order, order[:total - n]])
+            order = order[self.rank: total: self.world_size]
+
+        for i in range(len(self)):
+            index = order[i * self.batch_size: (i+1) * self.batch_size]
+            if self.logits is not None:
+                yield self.images[index], (self.labels[index], self.logits[index])
+            else:
+                yield self.images[index], self.labels[index]
+
+def load_resident(dataset):
+    """ all faces (N, H, W) uint8 & labels (N,) int64 of a dataset as contiguous numpy arrays """
+    if isinstance(dataset, FER2013):
+        if dataset.store is not None:
+            return dataset.store['faces'][dataset.index], dataset.store['labels'][dataset.index]
+        faces = decode_fer2013_pixels(dataset.df['pixels'].values)
+        return faces, dataset.df['emotion'].values.astype(np.int64)
+
+    if isinstance(dataset, PackedImageFolder):
+        return dataset.faces(), np.array(dataset.store['labels'])
+
+    if isinstance(dataset, DistillationDataset):
+        return load_resident(dataset.dataset)
+
+    if isinstance(dataset, Subset):
+        faces, labels = load_resident(dataset.dataset)
+        return faces[dataset.indices], labels[dataset.indices]
+
+    if isinstance(dataset, MultiTaskDataset):
+        faces, task_labels = zip(*[load_resident(d) for d in dataset.datasets])
+        labels = np.full((sum(len(l) for l in task_labels), dataset.num_tasks), -1, dtype=np.int64)
+        for task, (start, l) in enumerate(zip(np.cumsum([0] + dataset.cumulative_sizes[:-1]), task_labels)):
+            labels[start: start + len(l), task] = l
+        return np.concatenate(faces), labels
+
+    # any other dataset (e.g. ImageFolder) with a transform that returns uint8 faces
+    faces, labels = [], []
+    for i in range(len(dataset)):
+        face, label = dataset[i]
+        faces.append(np.asarray(face).reshape(np.shape(face)[-2:]))
+        labels.append(label)
+    return np.stack(faces).astype(np.uint8), np.array(labels, dtype=np.int64)
+
+def dataset_labels(dataset):
+    """ (N,) int64 labels of a dataset without loading its faces, (task, label) strata of a MultiTaskDataset """
+    if isinstance(dataset, FER2013):
+        if dataset.store is not None:
+            return np.asarray(dataset.store['labels'])[dataset.index]
+        return dataset.df['emotion'].values.astype(np.int64)
+    if isinstance(dataset, PackedImageFolder):
+        return np.array(dataset.store['labels'])
+    if isinstance(dataset, datasets.ImageFolder):
+        return np.array(dataset.targets, dtype=np.int64)
+    if isinstance(dataset, DistillationDataset):
+        return dataset_labels(dataset.dataset)
+    if isinstance(dataset, Subset):
+        return dataset_labels(dataset.dataset)[dataset.indices]
+    if isinstance(dataset, MultiTaskDataset):
+        # labels of the tasks are disjoint strata (task * 1000 + label)
+        return np.concatenate([task * 1000 + dataset_labels(d) for task, d in enumerate(dataset.datasets)])
+    return np.array([label for _, label in dataset], dtype=np.int64)
+
+def stratified_subset(dataset, fraction, seed=0):
+    """ Subset with fraction of the samples of each class (at least 1), the same one for a seed """
+    labels = dataset_labels(dataset)
+    rng = np.random.default_rng(seed)
+    indices = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        count = max(1, int(round(len(members) * fraction)))
+        indices.append(rng.choice(members, count, replace=False))
+    return Subset(dataset, np.sort(np.concatenate(indices)).tolist())
+
+def default_num_workers():
+    # keep one core for the training process itself
+    return max(0, min(8, (os.cpu_count() or 1) - 1))
+
+def uint8_collate(batch):
+    """
+    collate of raw uint8 faces (numpy (H,W) or tensor (1,H,W)) into a uint8 (B, 1, H, W) tensor,
+    4x less to copy / pin / transfer than float, the float conversion happens on the device
+    in augmentation.BatchAugmentation. Falls back to default_collate for anything else.
+    """
+    faces, labels = zip(*batch)
+    if not all(np.asarray(face).dtype == np.uint8 for face in faces):
+        return default_collate(batch)
+    faces = np.stack([np.asarray(face).reshape(np.shape(face)[-2:]) for face in faces])
+    images = torch.from_numpy(faces).unsqueeze(1)
+    # labels can be ints, multi task arrays or (label, teacher logits)
+    return images, default_collate(list(labels))
+
+class ShardSampler(Sampler):
+    """ samples rank, rank + world_size, ... of the dataset: unlike DistributedSampler no padding, each sample is evaluated once """
+    def __init__(self, dataset, rank=None, world_size=None):
+        self.rank = dist.get_rank() if rank is None else rank
+        self.world_size = dist.get_world_size() if world_size is None else world_size
+        self.indices = range(self.rank, len(dataset), self.world_size)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+def create_dataloader(dataset, batch_size, shuffle=False, num_workers=0, pin_memory=False, prefetch_factor=2,
+                      persistent_workers=False, drop_last=False, batch_augment=False, distributed=False, pad_shards=True):
+    """
+    single place where all the DataLoaders are built (FER2013 & ImageFolder, train & eval)
+    batch_augment: samples are raw uint8 faces, collated with uint8_collate
+    distributed: each process loads its shard with a DistributedSampler (call its set_epoch each epoch)
+    pad_shards: DistributedSampler shards padded to the same length (training, the ranks step together),
+    False for the evaluation: ShardSampler shards, the metrics summed over the ranks count each sample once
+    """
+    kwargs = {}
+    if distributed and pad_shards:
+        kwargs['sampler'] = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last)
+        shuffle = False
+    elif distributed:
+        kwargs['sampler'] = ShardSampler(dataset)
+        shuffle = False
+    # prefetch & persistent workers are only valid with worker processes
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+        kwargs['persistent_workers'] = persistent_workers
+
+    collate_fn = uint8_collate if batch_augment else None
+    return DataLoader(dataset, batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=pin_memory, drop_last=drop_last,
+                      collate_fn=collate_fn, **kwargs)
+
+# batch_augment: samples are returned as raw uint8 faces, equalization & augmentation
+# are done on the whole batch by augmentation.BatchAugmentation
+# loader_options: create_dataloader options (num_workers, pin_memory, ...)
+def create_train_dataloader(root='../data', batch_size=64, batch_augment=False, **loader_options):
+    transform = None if batch_augment else get_transforms()
+    dataset = FER2013(root, mode='train', transform=transform)
+    dataloader = create_dataloader(dataset, batch_size, shuffle=True, batch_augment=batch_augment, **loader_options)
     return dataloader
 
-def create_val_dataloader(root='../data', batch_size=2):
-    dataset = FER2013(root, mode='val', transform=transforms.ToTensor())
-    dataloader = DataLoader(dataset, batch_size, shuffle=False)
+def create_val_dataloader(root='../data', batch_size=2, batch_augment=False, **loader_options):
+    transform = None if batch_augment else transforms.ToTensor()
+    dataset = FER2013(root, mode='val', transform=transform)
+    dataloader = create_dataloader(dataset, batch_size, shuffle=False, batch_augment=batch_augment, **loader_options)
     return dataloader
 
-def create_test_dataloader(root='../data', batch_size=1):
+def create_test_dataloader(root='../data', batch_size=1, batch_augment=False, **loader_options):
     # transform = transforms.ToTensor()
-    transform = get_transforms()
+    transform = None if batch_augment else get_transforms()
     dataset = FER2013(root, mode='test', transform=transform)
-    dataloader = DataLoader(dataset, batch_size, shuffle=False)
+    dataloader = create_dataloader(dataset, batch_size, shuffle=False, batch_augment=batch_augment, **loader_options)
     return dataloader
 
-def calculate_dataset_mean_std(dataset:FER2013):
-    n = len(dataset)
-    means = []
-    stds = []
-    for i in range(n):
-        image, _ = dataset[i]
-        # image = image/ 255
-        mean = np.mean(image)
-        std = np.std(image)
-        means.append(mean)
-        stds.append(std)
-        print(f'i={i}, mean = {mean}, std = {std}')
-    mean = np.mean(means)
-    std = np.mean(stds)
-    print(f'\n\t Mean = {mean} ... Std = {std}\n')
+def create_eval_dataloader(root='data', batch_size=64, split='val', **loader_options):
+    """
+    no augmentation loader of root 'data': FER2013 PrivateTest (split 'val'), PublicTest ('test') or Training ('train'),
+    of an ImageFolder root: its Test split ('val' & 'test') or its Train split ('train')
+    """
+    if root == 'data':
+        dataset = FER2013(root, mode=split, transform=transforms.ToTensor())
+        return create_dataloader(dataset, batch_size, **loader_options)
+
+    transform = transforms.Compose([transforms.Grayscale(num_output_channels=1),
+                                    transforms.RandomEqualize(p=1),
+                                    transforms.ToTensor()])
+    folder = 'Train' if split == 'train' else 'Test'
+    dataset = create_image_folder_dataset(os.path.join(root, folder), transform, transforms.ToTensor())
+    return create_dataloader(dataset, batch_size, **loader_options)
 
 def test_dataloader_main():
     dataloader = create_test_dataloader()    
@@ -123,7 +442,9 @@ if __name__ == '__main__':
     print(f'dataset size = {len(dataset)}')
     
     if args.mean_std:
-        calculate_dataset_mean_std(dataset)
+        # local import, dataset_stats imports this module
+        from dataset_stats import compute_dataset_stats, print_stats
+        print_stats(compute_dataset_stats(dataset))
         exit(0)
  
     for i in range(len(dataset)):
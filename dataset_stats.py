@@ -0,0 +1,166 @@
+"""
+Description: One pass dataset statistics (mean / std / class counts / pixel histograms)
+
+Faces are read in chunks (FER2013 csv or store, packed ImageFolder store, ImageFolder tree),
+each chunk is reduced with numpy to (count, mean, M2, histograms) and the partial results are
+merged with the parallel Welford update (Chan et al.), so chunks can be processed by a pool of
+workers in any order. The result is saved in a json sidecar that utils.load_dataset_stats reads
+for the normalize_dataset_mode_* functions.
+"""
+import os
+import json
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from torchvision import datasets
+
+from dataset import FER2013, PackedImageFolder, create_image_folder_dataset
+from datastore import decode_fer2013_pixels, decode_face
+from utils import histogram_equalization, pil_histogram_equalization
+
+_worker_dataset = None
+
+
+def num_classes_of(dataset):
+    # FER2013 has no classes attribute, it has the 7 emotions
+    return len(getattr(dataset, 'classes', [])) or 7
+
+def read_chunk(dataset, start, stop):
+    """ faces [start, stop) of a dataset as a list / array of uint8 (H, W) faces & their labels """
+    if isinstance(dataset, FER2013):
+        if dataset.store is not None:
+            index = dataset.index[start:stop]
+            return dataset.store['faces'][index], dataset.store['labels'][index]
+        rows = dataset.df.iloc[start:stop]
+        return decode_fer2013_pixels(rows['pixels'].values), rows['emotion'].values
+
+    if isinstance(dataset, PackedImageFolder):
+        return dataset.faces(start, stop), np.array(dataset.store['labels'][start:stop])
+
+    if isinstance(dataset, datasets.ImageFolder):
+        samples = dataset.samples[start:stop]
+        return [decode_face(path, None) for path, _ in samples], np.array([label for _, label in samples])
+
+    faces, labels = zip(*[dataset[i] for i in range(start, stop)])
+    return [np.asarray(face).reshape(np.shape(face)[-2:]) for face in faces], np.array(labels)
+
+def chunk_stats(faces, labels, num_classes, equalize=None):
+    """ partial statistics of one chunk """
+    if equalize:
+        equalizer = histogram_equalization if equalize == 'cv2' else pil_histogram_equalization
+        faces = [equalizer(np.ascontiguousarray(face)) for face in faces]
+
+    labels = np.asarray(labels, dtype=np.int64)
+    sizes = np.array([np.size(face) for face in faces], dtype=np.int64)
+    pixels = np.concatenate([np.ravel(face) for face in faces]).astype(np.int64)
+    pixel_labels = np.repeat(labels, sizes)
+
+    class_histograms = np.bincount(pixel_labels * 256 + pixels, minlength=num_classes * 256).reshape(num_classes, 256)
+    count = pixels.size
+    mean = pixels.mean() if count else 0.0
+    return {
+        'count': count,
+        'mean': float(mean),
+        'm2': float(((pixels - mean) ** 2).sum()),
+        'class_counts': np.bincount(labels, minlength=num_classes),
+        'class_histograms': class_histograms,
+    }
+
+def merge_stats(a, b):
+    """ Chan et al. parallel variance update of two partial statistics """
+    if a is None:
+        return b
+    count = a['count'] + b['count']
+    if count == 0:
+        return a
+    delta = b['mean'] - a['mean']
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * b['count'] / count,
+        'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count,
+        'class_counts': a['class_counts'] + b['class_counts'],
+        'class_histograms': a['class_histograms'] + b['class_histograms'],
+    }
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+def _worker_chunk_stats(job):
+    start, stop, num_classes, equalize = job
+    faces, labels = read_chunk(_worker_dataset, start, stop)
+    return chunk_stats(faces, labels, num_classes, equalize)
+
+def compute_dataset_stats(dataset, chunk_size=4096, workers=1, equalize=None):
+    """
+    single pass statistics of all the faces of a dataset, in pixel range 0-255
+    equalize: None / 'cv2' / 'pil' computes the statistics of the equalized faces (what the model sees)
+    """
+    num_classes = num_classes_of(dataset)
+    jobs = [(start, min(start + chunk_size, len(dataset)), num_classes, equalize)
+            for start in range(0, len(dataset), chunk_size)]
+
+    total = None
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(dataset,)) as pool:
+            for partial in pool.imap_unordered(_worker_chunk_stats, jobs):
+                total = merge_stats(total, partial)
+    else:
+        _init_worker(dataset)
+        for job in jobs:
+            total = merge_stats(total, _worker_chunk_stats(job))
+
+    std = np.sqrt(total['m2'] / total['count']).item()
+    return {
+        'num_samples': len(dataset),
+        'num_pixels': total['count'],
+        'equalized': equalize is not None or getattr(dataset, 'equalized', False),
+        'mean': total['mean'],
+        'std': std,
+        'class_counts': total['class_counts'].tolist(),
+        'histogram': total['class_histograms'].sum(axis=0).tolist(),
+        'class_histograms': total['class_histograms'].tolist(),
+    }
+
+def stats_path(datapath, mode='train', image_folder='', equalized=False):
+    """ sidecar path: <root>/fer2013_<mode>_stats.json or <image folder>.stats.json """
+    suffix = '_equalized' if equalized else ''
+    if image_folder:
+        return image_folder.rstrip('/') + f'.stats{suffix}.json'
+    return os.path.join(datapath, f'fer2013_{mode}_stats{suffix}.json')
+
+def save_stats(stats, path):
+    with open(path, 'w') as f:
+        json.dump(stats, f)
+
+def print_stats(stats):
+    print(f'\n\t Mean = {stats["mean"]} ... Std = {stats["std"]}')
+    print(f'\t Mean = {stats["mean"] / 255} ... Std = {stats["std"] / 255} (0-1 range)')
+    print(f'\t class counts = {stats["class_counts"]}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datapath', type=str, default='data', help='root path of fer2013.csv / fer2013_store')
+    parser.add_argument('--mode', type=str, choices=['train', 'test', 'val'], default='train', help='FER2013 split')
+    parser.add_argument('--image_folder', type=str, default='', help='ImageFolder root (or its packed store) instead of FER2013')
+    parser.add_argument('--equalize', action='store_true', help='statistics of the equalized faces')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='faces per chunk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes computing the chunks')
+    args = parser.parse_args()
+
+    if args.image_folder:
+        dataset = create_image_folder_dataset(args.image_folder)
+        equalize = 'pil' if args.equalize else None
+    else:
+        dataset = FER2013(args.datapath, args.mode)
+        equalize = 'cv2' if args.equalize else None
+    # baked equalization is already in the faces
+    if getattr(dataset, 'equalized', False):
+        equalize = None
+
+    stats = compute_dataset_stats(dataset, args.chunk_size, args.workers, equalize)
+    path = stats_path(args.datapath, args.mode, args.image_folder, stats['equalized'])
+    save_stats(stats, path)
+    print_stats(stats)
+    print(f'Saved statistics in {path}')
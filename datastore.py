@@ -0,0 +1,297 @@
+"""
+Description: Memory-mapped binary stores for the datasets
+
+A store is a directory of .npy arrays plus a meta.json. The arrays are opened with
+np.load(mmap_mode='r') so every DataLoader worker shares the same page cache instead of
+holding its own copy of the data, and a sample is just a slice of the faces array.
+
+FER2013 store layout (<root>/fer2013_store):
+    faces.npy           (N, 48, 48) uint8
+    labels.npy          (N,) int64 emotion labels
+    usage.npy           (N,) int8 split code (see FER2013_USAGE)
+    <mode>_index.npy    row indices of each split (train / val / test)
+    meta.json
+
+ImageFolder packed store (<folder>.store, next to the ImageFolder root e.g. dataset_raf/Train.store):
+    faces_000.npy ...   (n_i, 48, 48) uint8 grayscale faces, split in shards of shard_size samples
+    labels.npy          (N,) int64 class index
+    meta.json           also holds classes, class_to_idx, face size & the shard sizes
+
+Deterministic preprocessing (grayscale, histogram equalization) can be baked into a store at
+conversion time. It is recorded in meta.json with PREPROCESS_VERSION, and a store built with
+another version or preprocessing is treated as stale and rebuilt by the ensure_* functions.
+"""
+import os
+import json
+import shutil
+import argparse
+import cv2
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from PIL import Image
+
+from utils import histogram_equalization, pil_histogram_equalization
+
+STORE_FORMAT = 2
+# bump when the baked preprocessing changes, stores built with an older version get rebuilt
+PREPROCESS_VERSION = 1
+META_FILE = 'meta.json'
+FER2013_STORE = 'fer2013_store'
+FER2013_USAGE = {'Training': 0, 'PrivateTest': 1, 'PublicTest': 2}
+MODE_USAGE = {'train': 'Training', 'val': 'PrivateTest', 'test': 'PublicTest'}
+
+
+class ArrayStore:
+    """
+    Read only view of a store directory. Arrays are memory-mapped lazily on first access,
+    and the maps are dropped when pickled so the store can be sent to DataLoader workers
+    (fork or spawn) without copying the data.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+            self._arrays[name] = array
+        return array
+
+    def __contains__(self, name):
+        return os.path.isfile(os.path.join(self.path, name + '.npy'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+def is_current(store):
+    """ False if the store was written by an older datastore.py or with older baked preprocessing """
+    return store.meta.get('format') == STORE_FORMAT and \
+        store.meta.get('preprocess', {}).get('version') == PREPROCESS_VERSION
+
+def write_store(path, arrays: dict, meta: dict):
+    """
+    write all arrays & meta into a temp dir then move it in place, so a crash in the middle
+    of a conversion never leaves a half written store that looks valid
+    """
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+
+    meta = dict(meta, format=STORE_FORMAT)
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+def preprocess_spec(equalize=None, grayscale=False):
+    """
+    equalize: None, 'cv2' (cv2.equalizeHist as FER2013) or 'pil' (ImageOps.equalize as transforms.RandomEqualize)
+    grayscale: PIL 'L' conversion as transforms.Grayscale(1)
+    """
+    assert equalize in [None, 'cv2', 'pil']
+    return {'version': PREPROCESS_VERSION, 'equalize': equalize, 'grayscale': grayscale}
+
+def equalize_faces(faces, equalize):
+    """ in place histogram equalization of (N, H, W) uint8 faces """
+    equalizer = histogram_equalization if equalize == 'cv2' else pil_histogram_equalization
+    for i in range(len(faces)):
+        faces[i] = equalizer(faces[i])
+    return faces
+
+def decode_fer2013_pixels(pixels) -> np.ndarray:
+    """ parse the space separated pixel strings of fer2013.csv into a (N, 48, 48) uint8 array """
+    faces = np.empty((len(pixels), 48, 48), dtype=np.uint8)
+    for i, row in enumerate(pixels):
+        faces[i] = np.fromstring(row, dtype=np.uint8, sep=' ').reshape(48, 48)
+    return faces
+
+def fer2013_store_path(root):
+    return os.path.join(root, FER2013_STORE)
+
+def convert_fer2013(root='data', equalize=None):
+    """ one time conversion of <root>/fer2013.csv into <root>/fer2013_store """
+    csv_path = os.path.join(root, 'fer2013.csv')
+    df = pd.read_csv(csv_path)
+
+    faces = decode_fer2013_pixels(df['pixels'].values)
+    if equalize:
+        equalize_faces(faces, equalize)
+    labels = df['emotion'].values.astype(np.int64)
+    usage = df['Usage'].map(FER2013_USAGE).values.astype(np.int8)
+
+    arrays = {'faces': faces, 'labels': labels, 'usage': usage}
+    for mode, usage_name in MODE_USAGE.items():
+        arrays[f'{mode}_index'] = np.flatnonzero(usage == FER2013_USAGE[usage_name]).astype(np.int64)
+
+    meta = {
+        'source': 'fer2013',
+        'csv_size': os.path.getsize(csv_path),
+        'num_samples': len(labels),
+        'shape': list(faces.shape[1:]),
+        'preprocess': preprocess_spec(equalize),
+    }
+    path = fer2013_store_path(root)
+    write_store(path, arrays, meta)
+    return path
+
+def open_fer2013_store(root):
+    """ returns the FER2013 store of root if it was converted, otherwise None """
+    path = fer2013_store_path(root)
+    if not is_store(path):
+        return None
+    store = ArrayStore(path)
+
+    # the csv was replaced after the conversion or the preprocessing code changed
+    csv_path = os.path.join(root, 'fer2013.csv')
+    csv_changed = os.path.isfile(csv_path) and os.path.getsize(csv_path) != store.meta.get('csv_size')
+    if csv_changed or not is_current(store):
+        print(f'{path} is stale, run datastore.py --datapath {root} to rebuild it')
+        return None
+    return store
+
+def ensure_fer2013_store(root, equalize=None):
+    """ open the FER2013 store with the given baked preprocessing, (re)building it when needed """
+    store = open_fer2013_store(root)
+    if store is None or store.meta['preprocess'] != preprocess_spec(equalize):
+        print(f'Building FER2013 store of {root} with equalize={equalize}')
+        convert_fer2013(root, equalize)
+        store = open_fer2013_store(root)
+    return store
+
+def image_folder_store_path(folder):
+    return folder.rstrip('/') + '.store'
+
+def shard_name(shard):
+    return f'faces_{shard:03d}'
+
+def folder_size(folder):
+    """ total size of the files under folder, cheap fingerprint to detect added / replaced images """
+    size = 0
+    for dirpath, _, filenames in os.walk(folder):
+        size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return size
+
+def decode_face(path, size=48):
+    """ grayscale (as transforms.Grayscale) face of an image file, resized to size x size (None = keep size) """
+    with open(path, 'rb') as f:
+        face = np.array(Image.open(f).convert('L'))
+    if size and face.shape != (size, size):
+        # same interpolation as the face preprocessing of camera_demo.py
+        face = cv2.resize(face, (size, size))
+    return face
+
+def _decode_face(job):
+    return decode_face(*job)
+
+def convert_image_folder(folder, equalize=None, size=48, shard_size=16384, workers=1):
+    """
+    one time pack of an ImageFolder tree (class per sub directory) into <folder>.store:
+    grayscale faces resized to size x size (size None keeps the original size, which then
+    must be the same for all images), optionally equalized, in shards of shard_size faces
+    """
+    # local import, only the ImageFolder conversion needs torchvision
+    from torchvision.datasets import ImageFolder
+    dataset = ImageFolder(folder)
+    jobs = [(path, size) for path, _ in dataset.samples]
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            decoded = pool.map(_decode_face, jobs, chunksize=256)
+    else:
+        decoded = [_decode_face(job) for job in jobs]
+
+    shapes = set(face.shape for face in decoded)
+    if len(shapes) > 1:
+        raise ValueError(f'{folder} has images of different sizes {shapes}, pack it with a face size')
+    faces = np.stack(decoded)
+    labels = np.array(dataset.targets, dtype=np.int64)
+
+    if equalize:
+        equalize_faces(faces, equalize)
+
+    arrays = {'labels': labels}
+    shards = []
+    for shard, start in enumerate(range(0, len(faces), shard_size)):
+        arrays[shard_name(shard)] = faces[start: start + shard_size]
+        shards.append(len(arrays[shard_name(shard)]))
+
+    meta = {
+        'source': 'image_folder',
+        'folder': os.path.abspath(folder),
+        'folder_size': folder_size(folder),
+        'num_samples': len(labels),
+        'shape': list(faces.shape[1:]),
+        'size': size,
+        'shards': shards,
+        'classes': dataset.classes,
+        'class_to_idx': dataset.class_to_idx,
+        'preprocess': preprocess_spec(equalize, grayscale=True),
+    }
+    path = image_folder_store_path(folder)
+    write_store(path, arrays, meta)
+    return path
+
+def open_image_folder_store(folder):
+    """ returns the packed store of an ImageFolder root if it was converted and is up to date, otherwise None """
+    path = image_folder_store_path(folder)
+    if not is_store(path):
+        return None
+    store = ArrayStore(path)
+
+    # images added / replaced after the packing or the preprocessing code changed
+    folder_changed = os.path.isdir(folder) and folder_size(folder) != store.meta.get('folder_size')
+    if folder_changed or not is_current(store):
+        print(f'{path} is stale, run datastore.py --image_folder {folder} to rebuild it')
+        return None
+    return store
+
+def ensure_image_folder_store(folder, equalize=None, size=48):
+    """ open the packed store of an ImageFolder root with the given preprocessing, (re)building it when needed """
+    store = open_image_folder_store(folder)
+    if store is None or store.meta['preprocess'] != preprocess_spec(equalize, grayscale=True) \
+            or store.meta['size'] != size:
+        print(f'Packing {folder} with equalize={equalize}, size={size}')
+        convert_image_folder(folder, equalize, size, workers=os.cpu_count() or 1)
+        store = open_image_folder_store(folder)
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datapath', type=str, default='data', help='root path of fer2013.csv')
+    parser.add_argument('--image_folder', type=str, nargs='+', default=[], help='pack these ImageFolder roots (e.g. dataset_raf/Train dataset_raf/Test) instead of FER2013')
+    parser.add_argument('--equalize', action='store_true', help='bake histogram equalization into the store')
+    parser.add_argument('--size', type=int, default=48, help='face size of the packed ImageFolder, 0 keeps the image size')
+    parser.add_argument('--shard_size', type=int, default=16384, help='faces per shard of the packed ImageFolder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='decoding processes')
+    args = parser.parse_args()
+
+    if args.image_folder:
+        for folder in args.image_folder:
+            path = convert_image_folder(folder, 'pil' if args.equalize else None, args.size or None,
+                                        args.shard_size, args.workers)
+            store = ArrayStore(path)
+            print(f'Packed {folder} in {path} .. {store.meta["num_samples"]} samples in {len(store.meta["shards"])} shards')
+            print(store.meta['class_to_idx'])
+        exit(0)
+
+    path = convert_fer2013(args.datapath, 'cv2' if args.equalize else None)
+    store = ArrayStore(path)
+    print(f'Saved FER2013 store in {path}')
+    for mode in MODE_USAGE:
+        print(f'\t{mode} = {len(store[mode + "_index"])} samples')
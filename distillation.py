@@ -0,0 +1,112 @@
+"""
+Description: Knowledge distillation from frozen teacher checkpoints (train.py --teachers)
+
+The teachers run once over the training faces (preprocessed as for validation, at the size the student
+trains on: native size for an ImageFolder, each logit is the average over the face & its horizontal
+flip, then over the teachers) and the logits are cached in a .npy file keyed by the teacher
+checkpoints & the dataset, so the next trainings only read them.
+The student is trained on the temperature softened teacher logits mixed with the labels.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import datasets
+
+from augmentation import BatchAugmentation
+from dataset import FER2013, load_resident
+from datastore import decode_face
+from model.inference import MODELS, load_model, checkpoint_hash
+
+
+def parse_teacher(teacher):
+    """ 'checkpoint' or 'checkpoint:Arch' (for checkpoints without arch, e.g. y_52_... :Mini_Yception) """
+    path, _, arch = teacher.rpartition(':')
+    if path and arch in MODELS:
+        return path, arch
+    return teacher, 'Mini_Xception'
+
+def dataset_faces(dataset):
+    """ raw uint8 (N, H, W) faces of a training dataset, in its order (a list of (H, W) faces for an ImageFolder) """
+    if isinstance(dataset, datasets.ImageFolder):
+        # native size, as the student sees them (equalized before any resize by image_transform)
+        return [decode_face(path, size=None) for path, _ in dataset.samples]
+    faces, _ = load_resident(dataset)
+    return faces
+
+def shape_batches(faces, batch_size):
+    """ index batches of the faces of the same shape (the ImageFolder faces can have different sizes) """
+    by_shape = {}
+    for i, face in enumerate(faces):
+        by_shape.setdefault(face.shape, []).append(i)
+    for indices in by_shape.values():
+        for start in range(0, len(indices), batch_size):
+            yield indices[start: start + batch_size]
+
+def dataset_key(dataset):
+    """ what identifies the faces of a dataset for the cache """
+    if isinstance(dataset, FER2013):
+        return f'fer2013:{os.path.abspath(dataset.root)}:{dataset.mode}'
+    if isinstance(dataset, datasets.ImageFolder):
+        return f'image_folder:{os.path.abspath(dataset.root)}:native_size'
+    return f'{type(dataset).__name__}:{os.path.abspath(dataset.store.path)}'
+
+def teacher_logits(teachers, faces, num_classes, equalize=None, batch_size=256, device='cpu'):
+    """ (N, num_classes) float32 logits of the teacher ensemble, flip averaged """
+    preprocess = BatchAugmentation(equalize).eval()
+    models = [load_model(path, arch, device=device) for path, arch in map(parse_teacher, teachers)]
+
+    logits = np.empty((len(faces), num_classes), dtype=np.float32)
+    with torch.no_grad():
+        for indices in shape_batches(faces, batch_size):
+            images = preprocess(torch.from_numpy(np.stack([faces[i] for i in indices])).to(device))
+            batch = 0
+            for model in models:
+                for x in [images, images.flip(-1)]:
+                    # Mini_Yception outputs more channels than classes, the first ones are the classes
+                    batch = batch + model(x).reshape(x.shape[0], -1)[:, :num_classes]
+            logits[indices] = (batch / (2 * len(models))).cpu().numpy()
+    return logits
+
+def cached_teacher_logits(teachers, dataset, num_classes, equalize=None, cache_dir='checkpoint/teacher_logits', device='cpu'):
+    """ teacher logits of each sample of dataset, computed once & then loaded from cache_dir """
+    key = json.dumps({
+        'teachers': [checkpoint_hash(parse_teacher(teacher)[0]) for teacher in teachers],
+        'dataset': dataset_key(dataset),
+        'size': len(dataset),
+        'num_classes': num_classes,
+        'equalize': equalize,
+    }, sort_keys=True)
+    path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16] + '.npy')
+    if os.path.isfile(path):
+        return np.load(path, mmap_mode='r')
+
+    logits = teacher_logits(teachers, dataset_faces(dataset), num_classes, equalize, device=device)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.tmp.npy'
+    np.save(tmp, logits)
+    os.replace(tmp, path)
+    print(f'\tSaved teacher logits in {path}')
+    return logits
+
+
+class DistillationLoss(nn.Module):
+    """
+    alpha * T^2 * KL(teacher || student) on the logits softened by temperature T
+    + (1 - alpha) * cross entropy with the labels, targets are (labels, teacher logits)
+    """
+    def __init__(self, temperature=4.0, alpha=0.7):
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, outputs, targets):
+        labels, logits = targets
+        outputs = outputs.reshape(labels.shape[0], -1)
+        hard = F.cross_entropy(outputs, labels)
+        soft = F.kl_div(F.log_softmax(outputs / self.temperature, dim=1), F.log_softmax(logits / self.temperature, dim=1),
+                        reduction='batchmean', log_target=True)
+        return self.alpha * self.temperature ** 2 * soft + (1 - self.alpha) * hard
@@ -0,0 +1,82 @@
+"""
+Description: Data parallel training helpers (torchrun, gloo backend by default so it runs on CPU nodes)
+
+    torchrun --nproc_per_node 4 train.py --batch_size 64 ...
+    torchrun --nnodes 2 --node_rank 0 --master_addr <host> --nproc_per_node 8 train.py ...
+
+Each process trains on its shard of the dataset (DistributedSampler / sharded ResidentLoader),
+the gradients are averaged by DistributedDataParallel, validation metrics are all-reduced
+and only rank 0 writes the checkpoints, logs & tensorboard.
+"""
+import os
+import math
+from contextlib import contextmanager
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """ joins the torchrun process group (WORLD_SIZE > 1 in the environment), returns True if distributed """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return True
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+def is_main_process():
+    return get_rank() == 0
+
+def local_threads():
+    """ cores of the node split between its processes (torchrun sets OMP_NUM_THREADS=1 otherwise) """
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    return max(1, (os.cpu_count() or 1) // local_world_size)
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+@contextmanager
+def main_process_first():
+    """ rank 0 runs the block first (e.g. builds a cache), the others run it after, reading the cache """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+def all_reduce_sum(tensor):
+    """ in place sum over the processes, returns tensor """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def scale_lr(lr, factor, rule='linear'):
+    """ learning rate for an effective batch factor times the batch lr was tuned for (e.g. the number of processes) """
+    if rule == 'linear':
+        return lr * factor
+    if rule == 'sqrt':
+        return lr * math.sqrt(factor)
+    return lr
+
+def set_epoch(dataloader, epoch):
+    """ reshuffles the shards of the DistributedSampler / ResidentLoader differently each epoch """
+    sampler = getattr(dataloader, 'sampler', None)
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
+    elif hasattr(dataloader, 'set_epoch'):
+        dataloader.set_epoch(epoch)
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,33 @@
+"""
+Description: Export trained checkpoints to inference optimized models
+"""
+import argparse
+import torch
+
+from model.inference import MODELS, export_fused, load_model
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained', type=str, required=True, help='training checkpoint')
+    parser.add_argument('--savepath', type=str, default='', help='exported checkpoint path (default: <pretrained>.fused.pth.tar)')
+    parser.add_argument('--arch', type=str, default='Mini_Xception', choices=list(MODELS.keys()), help='model class of the checkpoint')
+    parser.add_argument('--num_classes', type=int, default=0, help='number of classes, 0 = from the checkpoint')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    savepath = args.savepath or args.pretrained.replace('.pth.tar', '') + '.fused.pth.tar'
+
+    fused = export_fused(args.pretrained, savepath, args.arch, args.num_classes)
+    print(f'\tSaved BatchNorm folded model in {savepath}')
+
+    # sanity check of the folding against the original model
+    model = load_model(args.pretrained, args.arch, args.num_classes)
+    x = torch.rand(8, 1, 48, 48)
+    with torch.no_grad():
+        error = (model(x) - fused(x)).abs().max().item()
+    print(f'\tmax abs difference with the original model = {error}')
+
+if __name__ == '__main__':
+    main()
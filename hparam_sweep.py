@@ -0,0 +1,186 @@
+"""
+Description: Hyperparameter sweep of train.py, grid or random search with successive halving
+
+Trials run train.py concurrently (--workers processes of --threads torch threads each) on the
+memory mapped dataset stores (datastore.py), built once before the sweep & shared read only by
+all the trials through the page cache. Successive halving: every trial is trained for --min_epochs,
+the best 1 / --eta of them (validation accuracy of their last checkpoint) are resumed up to
+eta times more epochs, and so on until --max_epochs. All the trials end up in <sweep_dir>/results.csv.
+
+spec json:
+    {"search": "random", "trials": 16, "seed": 0,
+     "params": {"lr": {"min": 0.0001, "max": 0.01, "log": true}, "batch_size": [32, 64, 128], "weight_decay": [0, 1e-6, 1e-4]}}
+    grid search ("search": "grid") runs every combination of the lists, the other values are fixed
+    params are train.py arguments: a list value of a grid / random choice is one value (e.g. "blocks": [[8, 16, 32, 64]]),
+    true adds the flag only (e.g. "batch_augment": true)
+"""
+import os
+import sys
+import csv
+import math
+import json
+import random
+import argparse
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from datastore import ensure_fer2013_store, ensure_image_folder_store
+from arch_sweep import last_checkpoint
+
+
+def parse_args():
+    # no abbreviations, the unknown arguments go to train.py
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--spec', type=str, required=True, help='json search spec (see the module docstring)')
+    parser.add_argument('--sweep_dir', type=str, default='checkpoint/hparam_sweep', help='trials checkpoints, logs & results.csv')
+    parser.add_argument('--datapath', type=str, default='data', help='dataset root of the trials, training & validation')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4), help='trials running at the same time')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads of each trial, 0 = cores / workers')
+    parser.add_argument('--min_epochs', type=int, default=5, help='epochs of every trial before the first halving')
+    parser.add_argument('--max_epochs', type=int, default=45, help='epochs of the trials that survive every halving')
+    parser.add_argument('--eta', type=int, default=3, help='1 / eta of the trials survive each rung, which trains eta times longer')
+    # anything else goes to train.py (e.g. --batch_augment --amp bf16)
+    args, train_args = parser.parse_known_args()
+    if args.threads == 0:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+    return args, train_args
+
+# ===================== search space =====================
+def sample(value, rng):
+    """ one value of a random search param: list = choice, {"min", "max", "log"} = range, else fixed """
+    if isinstance(value, list):
+        return rng.choice(value)
+    if isinstance(value, dict):
+        low, high = value['min'], value['max']
+        if value.get('log'):
+            # 3 significant digits, the values end up in the log & checkpoint names
+            return float(f'{math.exp(rng.uniform(math.log(low), math.log(high))):.3g}')
+        if isinstance(low, int) and isinstance(high, int):
+            return rng.randint(low, high)
+        return float(f'{rng.uniform(low, high):.3g}')
+    return value
+
+def create_trials(spec):
+    """ list of {param: value} of the spec """
+    params = spec['params']
+    if spec.get('search', 'grid') == 'grid':
+        grid = {key: value if isinstance(value, list) else [value] for key, value in params.items()}
+        return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+    rng = random.Random(spec.get('seed', 0))
+    return [{key: sample(value, rng) for key, value in params.items()} for _ in range(spec.get('trials', 10))]
+
+def trial_args(params):
+    """ train.py arguments of a trial """
+    cli = []
+    for key, value in params.items():
+        if value is False or value is None:
+            continue
+        cli.append(f'--{key}')
+        if isinstance(value, list):
+            cli += [str(v) for v in value]
+        elif value is not True:
+            cli.append(str(value))
+    return cli
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    """ epochs trained at the end of each rung, min_epochs * eta^i up to max_epochs """
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1] * eta, max_epochs))
+    return epochs
+
+# ===================== trials =====================
+def prepare_stores(datapath):
+    """ memory mapped stores shared by the trials (train.py --preprocess opens them), built once here """
+    if datapath == 'data':
+        ensure_fer2013_store(datapath, equalize='cv2')
+    else:
+        for split in ['Train', 'Test']:
+            ensure_image_folder_store(os.path.join(datapath, split), equalize='pil')
+
+def run_trial(trial, epochs, args, train_args):
+    """ trains (or resumes) a trial up to epochs, returns the metrics of its last checkpoint """
+    directory = trial['directory']
+    train_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+    command = [sys.executable, train_py, *trial_args(trial['params']), '--epochs', str(epochs), '--preprocess',
+               '--datapath', args.datapath, '--test_datapath', args.datapath, '--savepath', directory,
+               '--tensorboard', os.path.join(directory, 'tensorboard'), '--logdir', os.path.join(directory, 'log'),
+               '--threads', str(args.threads), '--num_workers', '0', *train_args]
+    if trial['checkpoint']:
+        command += ['--resume', '--pretrained', trial['checkpoint']]
+
+    # OpenMP / MKL pools of the trial limited as well, not only torch's
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads), MKL_NUM_THREADS=str(args.threads))
+    with open(os.path.join(directory, 'train.out'), 'a') as out:
+        process = subprocess.run(command, stdout=out, stderr=subprocess.STDOUT, env=env)
+    if process.returncode != 0:
+        return dict(status='failed')
+
+    trial['checkpoint'] = last_checkpoint(directory)
+    checkpoint = torch.load(trial['checkpoint'], map_location='cpu')
+    return dict(status='done', epochs=checkpoint['epoch'] + 1, **checkpoint.get('metrics', {}))
+
+def write_results(trials, path):
+    keys = sorted(set(key for trial in trials for key in trial['params']))
+    columns = ['trial', *keys, 'epochs', 'accuracy', 'val_loss', 'percision', 'recall', 'status', 'checkpoint']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        for trial in trials:
+            writer.writerow({'trial': trial['name'], **trial['params'], **trial['result'], 'checkpoint': trial['checkpoint']})
+
+def print_results(trials):
+    keys = sorted(set(key for trial in trials for key in trial['params']))
+    print(f'\n{"trial":10s} ' + ' '.join(f'{key:>14s}' for key in keys) + f' {"epochs":>7s} {"accuracy":>9s}  status')
+    ranked = sorted(trials, key=lambda trial: trial['result'].get('accuracy', -1), reverse=True)
+    for trial in ranked:
+        result = trial['result']
+        accuracy = f'{result["accuracy"]*100:.2f} %' if 'accuracy' in result else '-'
+        values = ' '.join(f'{str(trial["params"].get(key, "")):>14s}' for key in keys)
+        print(f'{trial["name"]:10s} {values} {result.get("epochs", 0):7d} {accuracy:>9s}  {result["status"]}')
+
+def main():
+    args, train_args = parse_args()
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    prepare_stores(args.datapath)
+
+    trials = []
+    for i, params in enumerate(create_trials(spec)):
+        directory = os.path.join(args.sweep_dir, f'trial_{i}')
+        os.makedirs(directory, exist_ok=True)
+        trials.append(dict(name=f'trial_{i}', params=params, directory=directory, checkpoint=None, result=dict(status='pending')))
+    print(f'{len(trials)} trials .. {args.workers} at a time with {args.threads} threads each')
+
+    results_path = os.path.join(args.sweep_dir, 'results.csv')
+    alive = trials
+    epochs = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    with ThreadPoolExecutor(args.workers) as pool:
+        for rung, rung_epoch in enumerate(epochs):
+            print(f'\nrung {rung}: {len(alive)} trials up to {rung_epoch} epochs')
+            for trial, result in zip(alive, pool.map(lambda trial: run_trial(trial, rung_epoch, args, train_args), alive)):
+                trial['result'] = result
+                print(f'\t{trial["name"]} {trial_args(trial["params"])} .. accuracy = {result.get("accuracy", "-")}')
+            write_results(trials, results_path)
+
+            if rung + 1 == len(epochs):
+                break
+            # successive halving, the others keep their result of this rung
+            done = [trial for trial in alive if trial['result']['status'] == 'done']
+            done.sort(key=lambda trial: trial['result'].get('accuracy', -1), reverse=True)
+            alive = done[:max(1, len(done) // args.eta)]
+            for trial in done[len(alive):]:
+                trial['result']['status'] = f'stopped @ {rung_epoch}'
+            if not alive:
+                break
+
+    write_results(trials, results_path)
+    print_results(trials)
+    print(f'\nSaved results in {results_path}')
+
+if __name__ == '__main__':
+    main()
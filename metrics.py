@@ -0,0 +1,54 @@
+"""
+Description: Streaming classification metrics on the model's device
+
+A (classes, classes) confusion matrix is updated per batch with a single bincount, accuracy &
+macro precision / recall are derived from it once at the end, with the same numbers as sklearn's
+accuracy_score / precision_score / recall_score(average='macro') / confusion_matrix(normalize='true')
+(sklearn averages over the classes present in the labels or the predictions, 0 when undefined).
+"""
+import torch
+
+
+class ConfusionMatrix:
+    """ rows = labels, columns = predictions, labels < 0 (missing, see MultiTaskDataset) are ignored """
+    def __init__(self, num_classes, device='cpu'):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.int64, device=device)
+
+    def update(self, predictions, labels):
+        """ predictions & labels: (batch,) class indexes on the matrix device """
+        n = self.num_classes
+        # ignored samples go to an extra bin, a boolean mask would sync (data dependent shape)
+        index = torch.where(labels >= 0, labels * n + predictions, n * n)
+        self.matrix += torch.bincount(index.reshape(-1), minlength=n * n + 1)[:n * n].reshape(n, n)
+
+    def present(self):
+        """ classes in the labels or in the predictions """
+        matrix = self.matrix.cpu()
+        return ((matrix.sum(0) + matrix.sum(1)) > 0).nonzero().flatten()
+
+    def per_class(self):
+        """ (precision, recall) float64 tensors of each class, 0 for a class never predicted / labeled """
+        matrix = self.matrix.cpu().double()
+        tp = matrix.diag()
+        precision = tp / matrix.sum(0).clamp(min=1)
+        recall = tp / matrix.sum(1).clamp(min=1)
+        return precision, recall
+
+    def accuracy(self):
+        matrix = self.matrix.cpu()
+        return matrix.diag().sum().item() / max(matrix.sum().item(), 1)
+
+    def compute(self):
+        """ accuracy, macro precision, macro recall (python floats) """
+        present = self.present()
+        if len(present) == 0:
+            return 0.0, 0.0, 0.0
+        precision, recall = self.per_class()
+        return self.accuracy(), precision[present].mean().item(), recall[present].mean().item()
+
+    def normalized(self):
+        """ rows normalized by the label counts, over the present classes (numpy) """
+        present = self.present()
+        matrix = self.matrix.cpu().double()[present][:, present]
+        return (matrix / matrix.sum(1, keepdim=True).clamp(min=1)).numpy()
@@ -0,0 +1,101 @@
+"""
+Description: Per epoch JSONL metrics of train.py & the loaders of the runs (compare_runs.py, plotter.py)
+
+<logdir>_<prefix_><run name>.jsonl, next to the text log of the run, one json object per line:
+    {"run": "data_64_0.001_40_1e-06", "args": {...train.py arguments...}}                    first line
+    {"epoch": 0, "train_loss": 1.7, "train_samples_per_sec": 812.4, "lr": 0.001, "epoch_time": 61.2,
+     "wall_time": 61.2, "time": 1760000000.0, "val_loss": 1.69, "accuracy": 0.325, ...}     then each epoch
+A resumed run appends to it, the later line of an epoch wins. The text logs of the older runs
+(custom_logs/) are parsed line by line as well, their accuracies converted to fractions.
+"""
+import os
+import re
+import json
+import time
+
+
+class MetricsLog:
+    """ JSONL sink of the metrics of each epoch, flushed line by line so a killed run keeps its epochs """
+    def __init__(self, path, run, args, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w')
+        self.write(dict(run=run, args=args))
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=str) + '\n')
+        self.file.flush()
+
+    def log_epoch(self, metrics):
+        self.write(dict(metrics, time=time.time()))
+
+    def close(self):
+        self.file.close()
+
+
+# ===================== loaders =====================
+TRAIN_LINE = re.compile(r'\[?\s*training epoch=(\d+) \.\. train_loss=([-\d.e]+)')
+VAL_LINE = re.compile(r'\[?\s*validation epoch=(\d+) \.\. val_loss=([-\d.e]+)')
+# the per task lines of --joint (\t<task> .. Accuracy = ...) do not start with Accuracy
+METRICS_LINE = re.compile(r'\[?\s*Accuracy = ([-\d.e]+) % \.\. Percision = ([-\d.e]+) % \.\. Recall = ([-\d.e]+) %')
+# <logdir>_<prefix_><datapath>_<batch_size>_<lr>_<lr_patience>_<weight_decay>, prefix y / z of train_y.py / train_z.py
+TEXT_LOG_NAME = re.compile(r'(?:logging_)?(?:([yz])_)?(.+)_(\d+)_([-\d.e]+)_(\d+)_([-\d.e]+)$')
+
+
+def load_run(path):
+    """ {'name', 'path', 'args', 'epochs': [metrics of each epoch, in epoch order]} of a .jsonl or a text log """
+    if path.endswith('.jsonl'):
+        return load_jsonl(path)
+    return load_text_log(path)
+
+def load_jsonl(path):
+    args = {}
+    epochs = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a killed run
+                continue
+            if 'epoch' in record:
+                epochs[record['epoch']] = record
+            elif 'args' in record:
+                args = record['args']
+    return dict(name=run_label(path), path=path, args=args, epochs=[epochs[epoch] for epoch in sorted(epochs)])
+
+def load_text_log(path):
+    """ the text log of train.py, its hyperparameters from the log name """
+    epochs = {}
+    val_epoch = None
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = TRAIN_LINE.match(line)
+            if match:
+                epoch = int(match.group(1))
+                epochs.setdefault(epoch, dict(epoch=epoch))['train_loss'] = float(match.group(2))
+                continue
+            match = VAL_LINE.match(line)
+            if match:
+                val_epoch = int(match.group(1))
+                epochs.setdefault(val_epoch, dict(epoch=val_epoch))['val_loss'] = float(match.group(2))
+                continue
+            match = METRICS_LINE.match(line)
+            if match and val_epoch is not None:
+                accuracy, percision, recall = (round(float(value) / 100, 5) for value in match.groups())
+                epochs[val_epoch].update(accuracy=accuracy, percision=percision, recall=recall)
+
+    args = {}
+    match = TEXT_LOG_NAME.match(os.path.basename(path))
+    if match:
+        prefix, datapath, batch_size, lr, lr_patience, weight_decay = match.groups()
+        args = dict(prefix=prefix or '', datapath=datapath, batch_size=int(batch_size), lr=float(lr), lr_patience=int(lr_patience),
+                    weight_decay=float(weight_decay))
+    return dict(name=run_label(path), path=path, args=args, epochs=[epochs[epoch] for epoch in sorted(epochs)])
+
+def run_label(path):
+    """ name of a run in the tables & legends, its log name """
+    base = os.path.basename(path)
+    return base[:-len('.jsonl')] if base.endswith('.jsonl') else base
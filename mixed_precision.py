@@ -0,0 +1,34 @@
+"""
+Description: Mixed precision (autocast) helpers for training & inference
+
+    bf16: bfloat16 autocast, on CPU (AVX512-BF16 / AMX) & recent GPUs, no loss scaling needed
+    fp16: float16 autocast with a GradScaler for the loss scaling, GPUs only
+convs & matmuls run in the low precision, the ops that need float32 (softmax, losses) stay in float32.
+"""
+import torch
+
+AMP_MODES = ['', 'bf16', 'fp16']
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_amp(amp, device):
+    """ raises if the amp mode can not run on device """
+    assert amp in AMP_MODES
+    device = torch.device(device)
+    if amp == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        raise RuntimeError('bfloat16 is not supported by this GPU, use --amp fp16')
+    if amp == 'fp16' and device.type != 'cuda':
+        raise RuntimeError('float16 autocast is for GPUs, use --amp bf16 on CPU')
+
+def autocast(amp, device):
+    """ autocast context of the amp mode ('' = disabled, float32) """
+    device = torch.device(device)
+    return torch.autocast(device.type, dtype=AMP_DTYPES.get(amp, torch.bfloat16), enabled=bool(amp))
+
+def create_grad_scaler(amp, device):
+    """ loss scaling of fp16 (bf16 has the float32 range, it does not need it), a no-op otherwise """
+    device = torch.device(device)
+    # torch.amp.GradScaler handles CPU too (torch >= 2.3)
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type, enabled=amp == 'fp16')
+    return torch.cuda.amp.GradScaler(enabled=amp == 'fp16' and device.type == 'cuda')
@@ -0,0 +1,234 @@
+"""
+Description: Inference optimized models (BatchNorm folding, TorchScript / torch.compile) & checkpoint loading for the demos
+"""
+import io
+import os
+import re
+import copy
+import time
+import hashlib
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from model.model import NAMED_MODELS, Mini_Xception_MultiHead, ResidualZceptionBlock, build_model
+
+MODELS = dict(NAMED_MODELS, Mini_Xception_MultiHead=Mini_Xception_MultiHead)
+BACKENDS = ['eager', 'script', 'compile']
+
+
+def fuse_conv_bn_relu(block):
+    """ conv_bn_relu -> conv (BatchNorm folded in weights & bias) + ReLU """
+    conv, bn, relu = block
+    return nn.Sequential(fuse_conv_bn_eval(conv, bn), relu)
+
+def fuse_separable_conv_bn(separable_conv, bn):
+    """ SeparableConv2D + BatchNorm -> SeparableConv2D with the BatchNorm folded in the pointwise conv """
+    depthwise, pointwise = separable_conv
+    return nn.Sequential(depthwise, fuse_conv_bn_eval(pointwise, bn))
+
+
+class FusedResidualBlock(nn.Module):
+    """
+    ResidualXceptionBlock / ResidualZceptionBlock for inference, every BatchNorm folded in the preceding conv
+    conv + ReLU are adjacent so the TorchScript / oneDNN passes fuse them as well
+    """
+    def __init__(self, depthwise_conv1, depthwise_conv2, residual_conv, pool):
+        super(FusedResidualBlock, self).__init__()
+        self.depthwise_conv1 = depthwise_conv1
+        self.relu1 = nn.ReLU(inplace=True)
+        self.depthwise_conv2 = depthwise_conv2
+        self.pool = pool
+        self.residual_conv = residual_conv
+
+    def forward(self, x):
+        residual = self.residual_conv(x)
+
+        x = self.depthwise_conv1(x)
+        x = self.relu1(x)
+        x = self.depthwise_conv2(x)
+        x = self.pool(x)
+        return x + residual
+
+    @classmethod
+    def from_block(cls, block):
+        pool = block.global_avg_pool if isinstance(block, ResidualZceptionBlock) else block.maxpool
+        return cls(fuse_separable_conv_bn(block.depthwise_conv1, block.bn1),
+                   fuse_separable_conv_bn(block.depthwise_conv2, block.bn2),
+                   fuse_conv_bn_eval(block.residual_conv, block.residual_bn),
+                   pool)
+
+
+def fuse_model(model):
+    """
+    copy of a Mini_Xception / Yception / Zception for inference with all the BatchNorm layers folded
+    into the convs (model must be trained / loaded, the running statistics are baked in)
+    """
+    model = copy.deepcopy(model).eval()
+    model.conv1 = fuse_conv_bn_relu(model.conv1)
+    model.conv2 = fuse_conv_bn_relu(model.conv2)
+    model.residual_blocks = nn.ModuleList([FusedResidualBlock.from_block(block) for block in model.residual_blocks])
+    return model
+
+def infer_num_classes(state_dict):
+    # tuple of the classes of each head for Mini_Xception_MultiHead
+    if 'heads.0.weight' in state_dict:
+        num_heads = len([key for key in state_dict if key.startswith('heads.') and key.endswith('.weight')])
+        return tuple(state_dict[f'heads.{i}.weight'].shape[0] for i in range(num_heads))
+    # last conv of the head is built with output=num_classes (conv4 in Mini_Yception)
+    convs = [int(key[4:-len('.weight')]) for key in state_dict if re.fullmatch(r'conv\d+\.weight', key)]
+    return state_dict[f'conv{max(convs)}.weight'].shape[0]
+
+def create_model(arch='Mini_Xception', num_classes=7, config=None):
+    """ model of a checkpoint: named model arch, or a MiniXceptionNet when the checkpoint has a config """
+    if arch not in NAMED_MODELS:
+        return MODELS[arch](num_classes)
+    return build_model(arch, num_classes, **(config or {}))
+
+def export_fused(pretrained, savepath, arch='Mini_Xception', num_classes=None):
+    """ fold the BatchNorms of a training checkpoint and save an inference checkpoint """
+    checkpoint = torch.load(pretrained, map_location='cpu')
+    state_dict = checkpoint['mini_xception']
+    arch = checkpoint.get('arch', arch)
+    config = checkpoint.get('config')
+    num_classes = num_classes or infer_num_classes(state_dict)
+
+    model = create_model(arch, num_classes, config)
+    model.load_state_dict(state_dict)
+    fused = fuse_model(model)
+
+    torch.save({
+        'mini_xception': fused.state_dict(),
+        'arch': arch,
+        'config': config,
+        'num_classes': num_classes,
+        'fused': True,
+        'epoch': checkpoint.get('epoch', 0),
+    }, savepath)
+    return fused
+
+def load_model(pretrained, arch='Mini_Xception', num_classes=None, device='cpu'):
+    """
+    eval model of a checkpoint, either a training checkpoint or an inference one saved by export_fused
+    num_classes: taken from the checkpoint weights if not given
+    """
+    checkpoint = torch.load(pretrained, map_location='cpu')
+    state_dict = checkpoint['mini_xception']
+    arch = checkpoint.get('arch', arch)
+    num_classes = num_classes or checkpoint.get('num_classes') or infer_num_classes(state_dict)
+
+    model = create_model(arch, num_classes, checkpoint.get('config'))
+    if checkpoint.get('fused', False):
+        model = fuse_model(model)
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
+def checkpoint_hash(path):
+    """ short sha256 of a checkpoint file, key of the compiled artifacts cache """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+def compiled_cache_path(pretrained, model, device='cpu', channels_last=False):
+    """ <checkpoint>.<model class>.<checkpoint hash>.<device>[.channels_last].ts next to the checkpoint """
+    base = pretrained.replace('.pth.tar', '')
+    layout = '.channels_last' if channels_last else ''
+    device_type = torch.device(device).type
+    return f'{base}.{type(model).__name__}.{checkpoint_hash(pretrained)}.{device_type}{layout}.ts'
+
+def compile_model(model, pretrained, backend='eager', channels_last=False, device='cpu'):
+    """
+    compiled version of an eval model loaded from the checkpoint pretrained
+        eager: no compilation
+        script: traced & frozen TorchScript module, saved next to the checkpoint & reloaded on the next startups
+        compile: torch.compile (torch >= 2.0), the inductor cache is kept next to the checkpoint
+    channels_last: NHWC memory layout of the weights, faster convs on CPU with oneDNN
+    """
+    assert backend in BACKENDS
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format).eval()
+    if backend == 'eager':
+        return model
+
+    if backend == 'compile':
+        if not hasattr(torch, 'compile'):
+            print('torch.compile needs torch >= 2.0, running the eager model')
+            return model
+        cache_dir = pretrained.replace('.pth.tar', '') + '.inductor'
+        # only read by inductor on the first compilation of the process
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+        return torch.compile(model)
+
+    path = compiled_cache_path(pretrained, model, device, channels_last)
+    if os.path.isfile(path):
+        return torch.jit.load(path, map_location=device)
+
+    example = torch.rand(1, 1, 48, 48, device=device).contiguous(memory_format=memory_format)
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example)
+        scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, path)
+    print(f'\tSaved TorchScript model in {path}')
+    return scripted
+
+def measure_latency(model, batch_size=1, runs=100, warmup=10, device='cpu'):
+    """ mean forward latency in ms of a batch of 48x48 faces """
+    x = torch.rand(batch_size, 1, 48, 48, device=device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / runs * 1000
+
+def model_size(model):
+    """ serialized size in bytes of a model (TorchScript modules are saved whole, others by state_dict) """
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def count_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+def count_macs(model, input_size=(1, 1, 48, 48)):
+    """ multiply-accumulates of the convs & linear layers for one input of input_size """
+    macs = []
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output.numel() * kernel * module.in_channels // module.groups)
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.rand(input_size, device=device))
+    for hook in hooks:
+        hook.remove()
+    return sum(macs)
+
+def evaluate_accuracy(model, dataloader, device='cpu'):
+    """ top 1 accuracy of a (single head) model on a dataloader of float images """
+    correct, total = 0, 0
+    with torch.no_grad():
+        for images, labels in dataloader:
+            outputs = model(images.float().to(device)).reshape(images.shape[0], -1)
+            correct += (outputs.argmax(dim=1).cpu() == labels).sum().item()
+            total += labels.shape[0]
+    return correct / total
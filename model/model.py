@@ -30,15 +30,16 @@ def SeparableConv2D(in_channels, out_channels, kernel=3):
     )
 
 class ResidualXceptionBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel=3):
+    def __init__(self, in_channels, out_channels, kernel=3, mid_channels=None):
         super(ResidualXceptionBlock, self).__init__()
-        global device
+        # channels between the 2 separable convs, less than out_channels in pruned models
+        mid_channels = mid_channels or out_channels
 
-        self.depthwise_conv1 = SeparableConv2D(in_channels, out_channels, kernel).to(device)
-        self.bn1 = nn.BatchNorm2d(out_channels)
+        self.depthwise_conv1 = SeparableConv2D(in_channels, mid_channels, kernel)
+        self.bn1 = nn.BatchNorm2d(mid_channels)
         self.relu1 = nn.ReLU(inplace=True)
 
-        self.depthwise_conv2 = SeparableConv2D(out_channels, out_channels, kernel).to(device)
+        self.depthwise_conv2 = SeparableConv2D(mid_channels, out_channels, kernel)
         self.bn2 = nn.BatchNorm2d(out_channels)
 
         # self.padd = nn.ZeroPad2d(22)
@@ -71,15 +72,16 @@ class ResidualXceptionBlock(nn.Module):
         return x + residual
 
 class ResidualZceptionBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel=3):
+    def __init__(self, in_channels, out_channels, kernel=3, mid_channels=None):
         super(ResidualZceptionBlock, self).__init__()
-        global device
+        # channels between the 2 separable convs, less than out_channels in pruned models
+        mid_channels = mid_channels or out_channels
 
-        self.depthwise_conv1 = SeparableConv2D(in_channels, out_channels, kernel).to(device)
-        self.bn1 = nn.BatchNorm2d(out_channels)
+        self.depthwise_conv1 = SeparableConv2D(in_channels, mid_channels, kernel)
+        self.bn1 = nn.BatchNorm2d(mid_channels)
         self.relu1 = nn.ReLU(inplace=True)
 
-        self.depthwise_conv2 = SeparableConv2D(out_channels, out_channels, kernel).to(device)
+        self.depthwise_conv2 = SeparableConv2D(mid_channels, out_channels, kernel)
         self.bn2 = nn.BatchNorm2d(out_channels)
 
         # self.padd = nn.ZeroPad2d(22)
@@ -111,77 +113,52 @@ class ResidualZceptionBlock(nn.Module):
         # print('res',residual.shape)
         return x + residual
 
-class Mini_Xception(nn.Module):
-    def __init__(self, output=7):
-        super(Mini_Xception, self).__init__()
-
-        # self.conv1 = conv_bn_relu(1, 32, kernel_size=3, stride=1, padding=0)
-        # self.conv2 = conv_bn_relu(32, 64, kernel_size=3, stride=1, padding=0)
-        # self.residual_blocks = nn.ModuleList([
-        #     ResidualXceptionBlock(64 , 128).to(device),
-        #     ResidualXceptionBlock(128, 256).to(device),
-        #     ResidualXceptionBlock(256, 512).to(device),
-        #     ResidualXceptionBlock(512, 1024).to(device)            
-        # ])
-
-        # self.conv3 = nn.Conv2d(1024, 7, kernel_size=3, stride=1, padding=1)
-
-
-        self.conv1 = conv_bn_relu(1, 8, kernel_size=3, stride=1, padding=0)
-        self.conv2 = conv_bn_relu(8, 8, kernel_size=3, stride=1, padding=0)
+# configs of MiniXceptionNet of the named models
+#     stem: channels of conv1 & conv2
+#     blocks: output channels of each residual block
+#     pool: 'max' (ResidualXceptionBlock) or 'avg' (ResidualZceptionBlock) pooling in the blocks
+#     head: channels of the convs between the blocks & the classifier conv (conv3, conv4, ...)
+#     mid: channels between the separable convs of each block (None = the block output channels)
+#     legacy_head: the classifier conv is not run (Mini_Yception checkpoints were trained without conv4)
+DEFAULT_CONFIG = dict(mid=None, legacy_head=False)
+ARCHITECTURES = {
+    'Mini_Xception': dict(DEFAULT_CONFIG, stem=8, blocks=[16, 32, 64, 128], pool='max', head=[]),
+    'Mini_Yception': dict(DEFAULT_CONFIG, stem=8, blocks=[16, 32, 64, 128, 256], pool='max', head=[128], legacy_head=True),
+    'Mini_Zception': dict(DEFAULT_CONFIG, stem=8, blocks=[16, 32, 64, 128], pool='avg', head=[]),
+}
+POOLS = ['max', 'avg']
+
+class MiniXceptionNet(nn.Module):
+    """
+    Configurable mini-Xception: conv1 / conv2 stem, residual blocks, head convs & global average pooling
+    Parameter names are the ones of Mini_Xception / Yception / Zception, so their checkpoints load as they are.
+    config (see ARCHITECTURES) is kept in self.config & saved in the checkpoints by train.py
+    """
+    def __init__(self, output=7, stem=8, blocks=(16, 32, 64, 128), pool='max', head=(), mid=None, legacy_head=False):
+        super(MiniXceptionNet, self).__init__()
+        assert pool in POOLS
+        mid = list(mid) if mid else None
+        self.config = dict(stem=stem, blocks=list(blocks), pool=pool, head=list(head), mid=mid, legacy_head=legacy_head)
+        self.legacy_head = legacy_head
+        Block = ResidualXceptionBlock if pool == 'max' else ResidualZceptionBlock
+        mid = mid or list(blocks)
+
+        self.conv1 = conv_bn_relu(1, stem, kernel_size=3, stride=1, padding=0)
+        self.conv2 = conv_bn_relu(stem, stem, kernel_size=3, stride=1, padding=0)
+        channels = [stem] + list(blocks)
         self.residual_blocks = nn.ModuleList([
-            ResidualXceptionBlock(8 , 16).to(device),
-            ResidualXceptionBlock(16, 32).to(device),
-            ResidualXceptionBlock(32, 64).to(device),
-            ResidualXceptionBlock(64, 128).to(device)            
+            Block(in_channels, out_channels, mid_channels=mid_channels)
+            for in_channels, out_channels, mid_channels in zip(channels[:-1], channels[1:], mid)
         ])
-        self.conv3 = nn.Conv2d(128, output, kernel_size=3, stride=1, padding=1)
 
-        self.global_avg_pool = nn.AdaptiveAvgPool2d(1)
-
-    def forward(self, x):
-        
-        x = self.conv1(x)
-        x = self.conv2(x)
-
-        for block in self.residual_blocks:
-            x = block(x)
-            # print('ith block', x.shape, block.device)
-
-        # print('blocks:',x.shape)
-        x = self.conv3(x)
-        # print('conv3',x.shape)
-        x = self.global_avg_pool(x)
-        # # x = self.softmax(x)
-
-        return x
-
-class Mini_Yception(nn.Module):
-    def __init__(self, output=7):
-        super(Mini_Yception, self).__init__()
-
-        # self.conv1 = conv_bn_relu(1, 32, kernel_size=3, stride=1, padding=0)
-        # self.conv2 = conv_bn_relu(32, 64, kernel_size=3, stride=1, padding=0)
-        # self.residual_blocks = nn.ModuleList([
-        #     ResidualXceptionBlock(64 , 128).to(device),
-        #     ResidualXceptionBlock(128, 256).to(device),
-        #     ResidualXceptionBlock(256, 512).to(device),
-        #     ResidualXceptionBlock(512, 1024).to(device)
-        # ])
-
-        # self.conv3 = nn.Conv2d(1024, 7, kernel_size=3, stride=1, padding=1)
-
-        self.conv1 = conv_bn_relu(1, 8, kernel_size=3, stride=1, padding=0)
-        self.conv2 = conv_bn_relu(8, 8, kernel_size=3, stride=1, padding=0)
-        self.residual_blocks = nn.ModuleList([
-            ResidualXceptionBlock(8, 16).to(device),
-            ResidualXceptionBlock(16, 32).to(device),
-            ResidualXceptionBlock(32, 64).to(device),
-            ResidualXceptionBlock(64, 128).to(device),
-            ResidualXceptionBlock(128, 256).to(device)
-        ])
-        self.conv3 = nn.Conv2d(256, 128, kernel_size=3, stride=1, padding=1)
-        self.conv4 = nn.Conv2d(128, output, kernel_size=3, stride=1, padding=1)
+        # conv3, conv4, ... the last one is the classifier
+        channels = [channels[-1]] + list(head) + [output]
+        self.head_convs = []
+        for i, (in_channels, out_channels) in enumerate(zip(channels[:-1], channels[1:])):
+            name = f'conv{i + 3}'
+            setattr(self, name, nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1))
+            self.head_convs.append(name)
+        self.relu = nn.ReLU(inplace=True)
 
         self.global_avg_pool = nn.AdaptiveAvgPool2d(1)
 
@@ -191,40 +168,70 @@ class Mini_Yception(nn.Module):
 
         for block in self.residual_blocks:
             x = block(x)
-            # print('ith block', x.shape, block.device)
 
-        # print('blocks:',x.shape)
-        x = self.conv3(x)
-        # print('conv3',x.shape)
-        x = self.global_avg_pool(x)
-        # # x = self.softmax(x)
+        head_convs = self.head_convs[:-1] if self.legacy_head else self.head_convs
+        for i, name in enumerate(head_convs):
+            if i > 0:
+                x = self.relu(x)
+            x = getattr(self, name)(x)
 
+        x = self.global_avg_pool(x)
         return x
 
-class Mini_Zception(nn.Module):
+class Mini_Xception(MiniXceptionNet):
     def __init__(self, output=7):
-        super(Mini_Zception, self).__init__()
+        super(Mini_Xception, self).__init__(output, **ARCHITECTURES['Mini_Xception'])
 
-        # self.conv1 = conv_bn_relu(1, 32, kernel_size=3, stride=1, padding=0)
-        # self.conv2 = conv_bn_relu(32, 64, kernel_size=3, stride=1, padding=0)
-        # self.residual_blocks = nn.ModuleList([
-        #     ResidualXceptionBlock(64 , 128).to(device),
-        #     ResidualXceptionBlock(128, 256).to(device),
-        #     ResidualXceptionBlock(256, 512).to(device),
-        #     ResidualXceptionBlock(512, 1024).to(device)
-        # ])
+class Mini_Yception(MiniXceptionNet):
+    # legacy_head: the output is the 128 channels of conv3, conv4 is not used
+    def __init__(self, output=7):
+        super(Mini_Yception, self).__init__(output, **ARCHITECTURES['Mini_Yception'])
 
-        # self.conv3 = nn.Conv2d(1024, 7, kernel_size=3, stride=1, padding=1)
+class Mini_Zception(MiniXceptionNet):
+    def __init__(self, output=7):
+        super(Mini_Zception, self).__init__(output, **ARCHITECTURES['Mini_Zception'])
+
+NAMED_MODELS = {
+    'Mini_Xception': Mini_Xception,
+    'Mini_Yception': Mini_Yception,
+    'Mini_Zception': Mini_Zception,
+}
+
+def build_model(arch='Mini_Xception', output=7, **config):
+    """
+    model of the named architecture arch with some of its config replaced (see ARCHITECTURES,
+    None = unchanged). The named class itself when nothing changes, a MiniXceptionNet otherwise.
+    """
+    preset = ARCHITECTURES[arch]
+    config = dict(preset, **{key: value for key, value in config.items() if value is not None})
+    config['blocks'], config['head'] = list(config['blocks']), list(config['head'])
+    config['mid'] = list(config['mid']) if config['mid'] else None
+    if config == preset:
+        return NAMED_MODELS[arch](output)
+    return MiniXceptionNet(output, **config)
+
+class Mini_Xception_MultiHead(nn.Module):
+    """
+    Mini_Xception with the stem & residual blocks shared between several tasks (emotion & age)
+    and a conv3 + global pooling head per task, all the tasks in one forward pass
+        outputs: number of classes of each head, (7 emotions, 5 ages) by default
+    forward returns a tuple with the (batch, classes, 1, 1) output of each head
+    conv1 / conv2 / residual_blocks have the same names as in Mini_Xception
+    """
+    def __init__(self, outputs=(7, 5)):
+        super(Mini_Xception_MultiHead, self).__init__()
 
         self.conv1 = conv_bn_relu(1, 8, kernel_size=3, stride=1, padding=0)
         self.conv2 = conv_bn_relu(8, 8, kernel_size=3, stride=1, padding=0)
         self.residual_blocks = nn.ModuleList([
-            ResidualZceptionBlock(8, 16).to(device),
-            ResidualZceptionBlock(16, 32).to(device),
-            ResidualZceptionBlock(32, 64).to(device),
-            ResidualZceptionBlock(64, 128).to(device)
+            ResidualXceptionBlock(8 , 16),
+            ResidualXceptionBlock(16, 32),
+            ResidualXceptionBlock(32, 64),
+            ResidualXceptionBlock(64, 128)
+        ])
+        self.heads = nn.ModuleList([
+            nn.Conv2d(128, output, kernel_size=3, stride=1, padding=1) for output in outputs
         ])
-        self.conv3 = nn.Conv2d(128, output, kernel_size=3, stride=1, padding=1)
 
         self.global_avg_pool = nn.AdaptiveAvgPool2d(1)
 
@@ -234,15 +241,8 @@ class Mini_Zception(nn.Module):
 
         for block in self.residual_blocks:
             x = block(x)
-            # print('ith block', x.shape, block.device)
-
-        # print('blocks:',x.shape)
-        x = self.conv3(x)
-        # print('conv3',x.shape)
-        x = self.global_avg_pool(x)
-        # # x = self.softmax(x)
 
-        return x
+        return tuple(self.global_avg_pool(head(x)) for head in self.heads)
 
 if __name__ == '__main__':
     # x = torch.randn((2, 1, 64,64))
@@ -0,0 +1,104 @@
+"""
+Description: Structured channel pruning of the MiniXceptionNet models
+
+Channels are ranked by the magnitude of their BatchNorm gamma (a channel with a small gamma
+contributes little after the BatchNorm) and physically removed, which gives a smaller dense
+MiniXceptionNet (its config has the new block / mid widths) that runs faster as it is.
+    mid channels: output of the first separable conv of each block (bn1)
+    block outputs: shared by the residual sum (bn2 + residual_bn), the next block & the head
+"""
+import torch
+
+from model.model import MiniXceptionNet, build_model, NAMED_MODELS
+
+
+def bn_importance(*bns):
+    """ summed |gamma| of BatchNorms over the same channels """
+    return sum(bn.weight.detach().abs() for bn in bns)
+
+def keep_channels(importance, ratio):
+    """ sorted indexes of the channels kept when removing ratio of them (at least 1 is kept) """
+    keep = max(1, int(round(importance.numel() * (1 - ratio))))
+    return torch.sort(torch.topk(importance, keep).indices).values
+
+def _select_conv(conv, out_index=None, in_index=None):
+    weight = conv.weight.detach()
+    if out_index is not None:
+        weight = weight[out_index]
+    # depthwise convs (groups = channels) only have 1 input channel per filter
+    if in_index is not None and conv.groups == 1:
+        weight = weight[:, in_index]
+    state = {'weight': weight}
+    if conv.bias is not None:
+        state['bias'] = conv.bias.detach() if out_index is None else conv.bias.detach()[out_index]
+    return state
+
+def _select_bn(bn, index):
+    return {
+        'weight': bn.weight.detach()[index],
+        'bias': bn.bias.detach()[index],
+        'running_mean': bn.running_mean[index],
+        'running_var': bn.running_var[index],
+        'num_batches_tracked': bn.num_batches_tracked,
+    }
+
+def _add(state_dict, prefix, state):
+    for key, value in state.items():
+        state_dict[f'{prefix}.{key}'] = value.clone()
+
+def prune_model(model, ratio, prune_outputs=True):
+    """
+    copy of a (trained) MiniXceptionNet with ratio of the mid channels of each block removed,
+    and of the block output channels as well if prune_outputs. Returns the pruned model (eval).
+    """
+    assert isinstance(model, MiniXceptionNet) and 0 <= ratio < 1
+    config = dict(model.config)
+    stem_index = torch.arange(config['stem'])
+
+    mids, outputs = [], []
+    for block in model.residual_blocks:
+        mids.append(keep_channels(bn_importance(block.bn1), ratio))
+        if prune_outputs:
+            outputs.append(keep_channels(bn_importance(block.bn2, block.residual_bn), ratio))
+        else:
+            outputs.append(torch.arange(block.bn2.num_features))
+
+    config['mid'] = [len(index) for index in mids]
+    config['blocks'] = [len(index) for index in outputs]
+    arch = type(model).__name__ if type(model).__name__ in NAMED_MODELS else 'Mini_Xception'
+    num_classes = getattr(model, model.head_convs[-1]).out_channels
+    pruned = build_model(arch, num_classes, **config)
+
+    state_dict = {key: value.clone() for key, value in model.state_dict().items()
+                  if key.startswith('conv1.') or key.startswith('conv2.')}
+    in_index = stem_index
+    for i, (block, mid_index, out_index) in enumerate(zip(model.residual_blocks, mids, outputs)):
+        prefix = f'residual_blocks.{i}'
+        # separable conv 1: depthwise over the kept inputs, pointwise to the kept mid channels
+        _add(state_dict, f'{prefix}.depthwise_conv1.0', _select_conv(block.depthwise_conv1[0], in_index))
+        _add(state_dict, f'{prefix}.depthwise_conv1.1', _select_conv(block.depthwise_conv1[1], mid_index, in_index))
+        _add(state_dict, f'{prefix}.bn1', _select_bn(block.bn1, mid_index))
+        # separable conv 2: depthwise over the kept mid channels, pointwise to the kept outputs
+        _add(state_dict, f'{prefix}.depthwise_conv2.0', _select_conv(block.depthwise_conv2[0], mid_index))
+        _add(state_dict, f'{prefix}.depthwise_conv2.1', _select_conv(block.depthwise_conv2[1], out_index, mid_index))
+        _add(state_dict, f'{prefix}.bn2', _select_bn(block.bn2, out_index))
+        _add(state_dict, f'{prefix}.residual_conv', _select_conv(block.residual_conv, out_index, in_index))
+        _add(state_dict, f'{prefix}.residual_bn', _select_bn(block.residual_bn, out_index))
+        in_index = out_index
+
+    # first head conv reads the kept outputs of the last block, the others are unchanged
+    for j, name in enumerate(model.head_convs):
+        state = _select_conv(getattr(model, name), in_index=in_index if j == 0 else None)
+        _add(state_dict, name, state)
+
+    pruned.load_state_dict(state_dict)
+    return pruned.eval()
+
+def save_pruned(model, savepath, arch='Mini_Xception', epoch=0):
+    """ checkpoint of a pruned model in the train.py format (--finetune / --resume rebuild its config) """
+    torch.save({
+        'mini_xception': model.state_dict(),
+        'epoch': epoch,
+        'arch': arch,
+        'config': model.config,
+    }, savepath)
@@ -0,0 +1,75 @@
+"""
+Description: INT8 quantization of the models (static post training & quantization aware training)
+
+FX graph mode quantization: the models are traced, conv + bn + relu are fused and observers
+are inserted without any change to model.py. Quantized models run on CPU only, with the
+fbgemm (x86) or qnnpack (ARM) kernels, and are saved as TorchScript.
+"""
+import os
+import copy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+
+QUANTIZED_BACKENDS = ['fbgemm', 'qnnpack']
+
+
+def example_inputs():
+    return (torch.rand(1, 1, 48, 48),)
+
+def set_backend(backend):
+    if backend not in torch.backends.quantized.supported_engines:
+        raise RuntimeError(f'quantized backend {backend} is not supported by this torch build '
+                           f'({torch.backends.quantized.supported_engines})')
+    torch.backends.quantized.engine = backend
+
+def prepare_static(model, backend='fbgemm'):
+    """ eval copy of a float model with observers, to be calibrated then converted """
+    set_backend(backend)
+    model = copy.deepcopy(model).cpu().eval()
+    return prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs())
+
+def calibrate(prepared, dataloader, num_batches=32):
+    """ runs num_batches of (float) images through the observers """
+    with torch.no_grad():
+        for i, (images, _) in enumerate(dataloader):
+            if i == num_batches:
+                break
+            prepared(images.float())
+    return prepared
+
+def quantize_static(model, dataloader, backend='fbgemm', num_batches=32):
+    """ static post training quantization calibrated on num_batches of dataloader """
+    prepared = prepare_static(model, backend)
+    calibrate(prepared, dataloader, num_batches)
+    return convert_fx(prepared)
+
+def prepare_qat(model, backend='fbgemm'):
+    """ copy of a float model with fake quantization, trained like the float one (train.py --qat) """
+    set_backend(backend)
+    model = copy.deepcopy(model).cpu().train()
+    return prepare_qat_fx(model, get_default_qat_qconfig_mapping(backend), example_inputs())
+
+def convert_qat(model):
+    """ int8 model of a quantization aware trained one """
+    return convert_fx(copy.deepcopy(model).cpu().eval())
+
+def int8_path(pretrained):
+    return pretrained.replace('.pth.tar', '') + '.int8.ts'
+
+def save_int8(model, path, backend='fbgemm'):
+    """ TorchScript of a quantized model, the backend it was quantized for is stored in the file """
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model.eval(), example_inputs()))
+    torch.jit.save(scripted, path, _extra_files={'qbackend': backend})
+    return os.path.getsize(path)
+
+def load_int8(path):
+    """ quantized TorchScript model saved by save_int8 (CPU only) """
+    extra_files = {'qbackend': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    backend = extra_files['qbackend']
+    if isinstance(backend, bytes):
+        backend = backend.decode()
+    set_backend(backend)
+    return model
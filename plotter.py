@@ -1,61 +1,32 @@
-import time
+"""
+Description: Accuracy & validation loss curves of two runs (compare_runs.py plots & tabulates any number of them)
 
+    python plotter.py --logs custom_logs/logging_data_15_0.001_40_1e-06 custom_logs/logging_data_15_0.0001_40_1e-06 --metric accuracy
+"""
+import argparse
 import matplotlib.pyplot as plt
-import numpy as np
-import random
 
-def get_train_data(log):
-    with open(log, "r") as f:
-        list = f.read().split("\n")
-
-    list.pop(0)
-    list.pop(0)
-    list.pop(0)
-    list.pop(0)
-    list.pop(0)
-
-    epochList = []
-    train_loss = []
-    val_loss = []
-    Accuracy = []
-    Percision = []
-    Recall = []
-
-    for string in list:
-        if (string != ""):
-            epochList.append(string)
+from metrics_log import load_run
 
-    count = 0
-    for x in epochList:
-        index = epochList.index(x)
-        if index % 3 == 0:
-            count += 1
-            # print(x.split("loss=")[1])
-            train_loss.append(float(x.split("loss=")[1]))
-        elif index % 3 == 1:
-            # print(x)
-            val_loss.append(float(x.split("loss=")[1]))
-        else:
-            Accuracy.append(float(x.split(" ")[2]))
-            Percision.append(float(x.split(" ")[7]))
-            Recall.append(float(x.split(" ")[12]))
-
-    arr = np.array(Recall)
+def get_train_data(log):
+    """ metrics of each epoch of a text log or JSONL metrics log of train.py, accuracies in % """
+    epochs = load_run(log)['epochs']
+    validated = [epoch for epoch in epochs if 'accuracy' in epoch]
 
     data = {
-        "epochs": range(0, count),
-        "train_loss": train_loss,
-        "val_loss": val_loss,
-        "accuracy": Accuracy,
-        "percision": Percision,
-        "recall": Recall
+        "epochs": [epoch['epoch'] for epoch in epochs],
+        "train_loss": [epoch.get('train_loss') for epoch in epochs],
+        "val_loss": [epoch['val_loss'] for epoch in validated],
+        "accuracy": [epoch['accuracy'] * 100 for epoch in validated],
+        "percision": [epoch['percision'] * 100 for epoch in validated],
+        "recall": [epoch['recall'] * 100 for epoch in validated]
     }
 
     return data
 
-def acc(a,b):
-    plt.plot(a["accuracy"], label="0.001", color=(1,0,0))
-    plt.plot(b["accuracy"], label="0.0001", color=(0,0,1))
+def acc(a,b, labels=("0.001", "0.0001")):
+    plt.plot(a["accuracy"], label=labels[0], color=(1,0,0))
+    plt.plot(b["accuracy"], label=labels[1], color=(0,0,1))
 
     plt.grid()
     plt.legend()
@@ -64,9 +35,9 @@ def acc(a,b):
     plt.ylabel("Accuracy")
     plt.show()
 
-def loss(a,b):
-    plt.plot(a["val_loss"], label="0.001", color=(1, 0, 0))
-    plt.plot(b["val_loss"], label="0.0001", color=(0, 0, 1))
+def loss(a,b, labels=("0.001", "0.0001")):
+    plt.plot(a["val_loss"], label=labels[0], color=(1, 0, 0))
+    plt.plot(b["val_loss"], label=labels[1], color=(0, 0, 1))
 
     plt.grid()
     plt.legend()
@@ -74,8 +45,18 @@ def loss(a,b):
     plt.ylabel("Validation Loss")
     plt.show()
 
-plt.title("MiniXception / FER2013 Dataset / Batch Size:15")
-a = get_train_data("custom_logs/logging_data_15_0.001_40_1e-06")
-b = get_train_data("checkpoint/logging_data_15_0.0001_40_1e-06")
-loss(a,b)
-
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logs', type=str, nargs=2, default=["custom_logs/logging_data_15_0.001_40_1e-06", "custom_logs/logging_data_15_0.0001_40_1e-06"], help='the two runs')
+    parser.add_argument('--labels', type=str, nargs=2, default=["0.001", "0.0001"], help='legend of the two runs')
+    parser.add_argument('--title', type=str, default="MiniXception / FER2013 Dataset / Batch Size:15")
+    parser.add_argument('--metric', type=str, default='loss', choices=['loss', 'accuracy'])
+    args = parser.parse_args()
+
+    plt.title(args.title)
+    a = get_train_data(args.logs[0])
+    b = get_train_data(args.logs[1])
+    if args.metric == 'accuracy':
+        acc(a, b, args.labels)
+    else:
+        loss(a, b, args.labels)
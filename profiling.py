@@ -0,0 +1,44 @@
+"""
+Description: torch.profiler window of the training, validation & camera demo loops (--profile)
+
+    python train.py --profile --profile_steps 10 ...      first training epoch & first validation
+    python camera_demo.py --profile ...                     first frames of the demo
+    tensorboard --logdir checkpoint/tensorboard             PyTorch Profiler tab (torch-tb-profiler)
+
+The loops call step() once per batch / frame: the profiler skips --profile_wait steps, warms up
+for --profile_warmup & records the next --profile_steps (CPU ops with their input shapes & memory,
+CUDA kernels too on GPU). The trace is saved in <tensorboard>/profile_<name> (a Chrome trace json,
+chrome://tracing or https://ui.perfetto.dev open it as well) & the top operators are printed.
+Without --profile the loops get a NullProfiler, a no-op step() per batch.
+"""
+import os
+import torch
+from torch.profiler import profile, schedule, tensorboard_trace_handler, ProfilerActivity
+
+
+class NullProfiler:
+    """ stands in for the profiler when profiling is off """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def step(self):
+        pass
+
+
+def create_profiler(logdir, name, wait=1, warmup=1, active=5, top=15):
+    """ profiler of one window of steps, saves the trace in logdir/profile_<name> & prints the top operators """
+    tracedir = os.path.join(logdir, f'profile_{name}')
+    save_trace = tensorboard_trace_handler(tracedir, worker_name=name)
+
+    def trace_ready(profiler):
+        save_trace(profiler)
+        print(f'\n\t*** {name} profile of {active} steps, trace saved in {tracedir} ***\n')
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        print(profiler.key_averages().table(sort_by=sort_by, row_limit=top))
+
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+    return profile(activities=activities, schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                   on_trace_ready=trace_ready, record_shapes=True, profile_memory=True)
@@ -0,0 +1,83 @@
+"""
+Description: Structured pruning of a trained checkpoint at several ratios, fine tuning with train.py
+& accuracy / latency report per ratio (see model/pruning.py)
+"""
+import os
+import sys
+import argparse
+import subprocess
+import torch
+
+from model.inference import MODELS, load_model, evaluate_accuracy
+from model.pruning import prune_model, save_pruned
+from dataset import create_eval_dataloader
+from arch_sweep import benchmark_config, last_checkpoint
+
+
+def parse_args():
+    # no abbreviations, the unknown arguments go to train.py
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--pretrained', type=str, required=True, help='trained checkpoint to prune')
+    parser.add_argument('--arch', type=str, default='Mini_Xception', choices=list(MODELS.keys()), help='model class of the checkpoint (if not saved in it)')
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75], help='ratios of channels removed in each layer')
+    parser.add_argument('--mid_only', action='store_true', help='only prune the channels inside the blocks, keep the block outputs')
+    parser.add_argument('--savepath', type=str, default='checkpoint/pruned', help='pruned & fine tuned checkpoints')
+    parser.add_argument('--finetune_epochs', type=int, default=0, help='fine tune each pruned model with train.py, 0 = no fine tuning')
+    parser.add_argument('--datapath', type=str, default='data', help='dataset root, fine tuning & validation (FER2013 PrivateTest or ImageFolder Test)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64], help='batch sizes of the latency measurements')
+    parser.add_argument('--runs', type=int, default=50, help='timed forward passes of each latency measurement')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads for the latency measurements')
+    # anything else goes to train.py (e.g. --batch_size 64 --lr 0.0001 --age_mode)
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+def finetune(checkpoint, arch, args, train_args):
+    """ fine tunes a pruned checkpoint with train.py --finetune, returns its last checkpoint """
+    directory = checkpoint.replace('.pth.tar', '')
+    os.makedirs(directory, exist_ok=True)
+    train_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+    command = [sys.executable, train_py, '--finetune', '--pretrained', checkpoint, '--arch', arch,
+               '--epochs', str(args.finetune_epochs), '--datapath', args.datapath, '--test_datapath', args.datapath,
+               '--savepath', directory, '--tensorboard', os.path.join(directory, 'tensorboard'),
+               '--logdir', os.path.join(directory, 'log'), *train_args]
+    print(' '.join(command))
+    subprocess.run(command, check=True)
+    return last_checkpoint(directory)
+
+def print_results(results, batch_sizes):
+    latencies = ' '.join(f'{"b" + str(b) + " ms":>9s}' for b in batch_sizes)
+    print(f'\n{"ratio":>6s} {"params":>9s} {"MMACs":>8s} {latencies} {"pruned":>9s} {"finetuned":>10s}')
+    for r in results:
+        latencies = ' '.join(f'{r["latency_ms"][b]:9.2f}' for b in batch_sizes)
+        finetuned = '-' if r['finetuned_accuracy'] is None else f'{r["finetuned_accuracy"]*100:.2f} %'
+        print(f'{r["ratio"]:6.2f} {r["params"]:9d} {r["macs"]/1e6:8.2f} {latencies} {r["accuracy"]*100:7.2f} % {finetuned:>10s}')
+
+def main():
+    args, train_args = parse_args()
+    torch.set_num_threads(args.threads)
+    os.makedirs(args.savepath, exist_ok=True)
+
+    model = load_model(args.pretrained, args.arch)
+    arch = torch.load(args.pretrained, map_location='cpu').get('arch', args.arch)
+    dataloader = create_eval_dataloader(args.datapath, batch_size=64)
+
+    results = []
+    for ratio in [0] + args.ratios:
+        pruned = prune_model(model, ratio, prune_outputs=not args.mid_only) if ratio else model
+        result = dict(ratio=ratio, config=pruned.config, accuracy=evaluate_accuracy(pruned, dataloader), finetuned_accuracy=None)
+        result.update(benchmark_config(pruned, args.batch_sizes, args.runs))
+
+        if ratio:
+            checkpoint = os.path.join(args.savepath, f'pruned_{ratio:.2f}.pth.tar')
+            save_pruned(pruned, checkpoint, arch)
+            print(f'\tSaved pruned model in {checkpoint}')
+            if args.finetune_epochs:
+                checkpoint = finetune(checkpoint, arch, args, train_args)
+                result['finetuned_accuracy'] = evaluate_accuracy(load_model(checkpoint), dataloader)
+            result['checkpoint'] = checkpoint
+        results.append(result)
+
+    print_results(results, args.batch_sizes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Description: INT8 static post training quantization of a trained checkpoint, with accuracy / latency / size report
+"""
+import argparse
+import torch
+
+from model.inference import MODELS, load_model, measure_latency, model_size, evaluate_accuracy
+from model.quantization import QUANTIZED_BACKENDS, quantize_static, save_int8, load_int8, int8_path
+from dataset import create_eval_dataloader
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained', type=str, required=True, help='float checkpoint (training or BatchNorm folded)')
+    parser.add_argument('--savepath', type=str, default='', help='int8 TorchScript path (default: <pretrained>.int8.ts)')
+    parser.add_argument('--arch', type=str, default='Mini_Xception', choices=list(MODELS.keys()), help='model class of the checkpoint')
+    parser.add_argument('--num_classes', type=int, default=0, help='number of classes, 0 = from the checkpoint')
+    parser.add_argument('--datapath', type=str, default='data', help='data (FER2013, calibration on PrivateTest, evaluation on PublicTest) or ImageFolder root (calibration on Train, evaluation on Test)')
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=QUANTIZED_BACKENDS, help='fbgemm for x86, qnnpack for ARM')
+    parser.add_argument('--calib_batches', type=int, default=32, help='shuffled batches used for calibration, held out of the evaluation')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads for the latency measurement')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    savepath = args.savepath or int8_path(args.pretrained)
+
+    model = load_model(args.pretrained, args.arch, args.num_classes)
+    # calibration & evaluation on different splits, the int8 accuracy is not biased toward the calibration faces
+    calib_split = 'val' if args.datapath == 'data' else 'train'
+    calib_dataloader = create_eval_dataloader(args.datapath, args.batch_size, split=calib_split, shuffle=True)
+    dataloader = create_eval_dataloader(args.datapath, args.batch_size, split='test')
+
+    quantized = quantize_static(model, calib_dataloader, args.backend, args.calib_batches)
+    save_int8(quantized, savepath, args.backend)
+    quantized = load_int8(savepath)
+    print(f'\tSaved int8 model in {savepath}\n')
+
+    # ============== report ==============
+    torch.set_num_threads(args.threads)
+    report = {}
+    for name, m in [('float32', model), ('int8', quantized)]:
+        accuracy = evaluate_accuracy(m, dataloader)
+        latency_1 = measure_latency(m, batch_size=1)
+        latency_8 = measure_latency(m, batch_size=8)
+        size = model_size(m) / 1024
+        report[name] = accuracy, latency_1, latency_8, size
+        print(f'{name:8s} .. Accuracy = {round(accuracy*100, 2)} % .. latency = {round(latency_1, 2)} ms (batch 1) '
+              f'{round(latency_8, 2)} ms (batch 8) .. size = {round(size, 1)} KB')
+
+    (fp32_accuracy, fp32_1, fp32_8, fp32_size), (int8_accuracy, int8_1, int8_8, int8_size) = report['float32'], report['int8']
+    print(f'int8 - float32 .. Accuracy {(int8_accuracy - fp32_accuracy)*100:+.2f} % .. latency x{fp32_1 / int8_1:.2f} faster (batch 1) '
+          f'x{fp32_8 / int8_8:.2f} faster (batch 8) .. size x{fp32_size / int8_size:.2f} smaller')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Description: Learning rate schedules of train.py (--schedule), for the same accuracy in fewer epochs
+
+    plateau:  ReduceLROnPlateau on the validation loss, steps on each validation (the original schedule)
+    onecycle: warmup to --lr then annealing down to ~0 at the last epoch, steps on each optimizer step
+    cosine:   linear warmup for --warmup_epochs then cosine decay to 0 at the last epoch, steps on each optimizer step
+
+With larger batches (--batch_size, --accumulate, processes) the lr is scaled by the effective batch
+over --base_batch (see distributed.scale_lr), the warmup keeps the first steps of the large lr stable.
+"""
+import math
+from functools import partial
+import torch
+
+SCHEDULES = ['plateau', 'onecycle', 'cosine']
+
+
+def optimizer_steps(batches, accumulate=1):
+    """ optimizer steps of an epoch of batches, the last incomplete accumulation steps as well """
+    return math.ceil(batches / accumulate)
+
+def warmup_cosine(step, warmup_steps, total_steps):
+    """ lr factor of step: linear from 1 / warmup_steps to 1, then cosine from 1 to 0 """
+    if step < warmup_steps:
+        return (step + 1) / warmup_steps
+    progress = (step - warmup_steps) / max(1, total_steps - warmup_steps)
+    return 0.5 * (1 + math.cos(math.pi * min(1.0, progress)))
+
+def create_scheduler(schedule, optimizer, epochs, steps_per_epoch, warmup_epochs=0, patience=40, start_step=0):
+    """
+    lr scheduler of the optimizer for a run of epochs x steps_per_epoch optimizer steps,
+    start_step: optimizer steps already taken (the last_epoch of the scheduler of a resumed run)
+    """
+    assert schedule in SCHEDULES
+    total_steps = max(1, epochs * steps_per_epoch)
+    warmup_steps = round(warmup_epochs * steps_per_epoch)
+    if schedule == 'onecycle':
+        # 30 % of the run warming up unless --warmup_epochs says otherwise
+        pct_start = min(0.99, warmup_steps / total_steps) if warmup_steps else 0.3
+        return torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=[group['lr'] for group in optimizer.param_groups],
+                                                   total_steps=total_steps, pct_start=pct_start, last_epoch=start_step - 1)
+    if schedule == 'cosine':
+        return torch.optim.lr_scheduler.LambdaLR(optimizer, partial(warmup_cosine, warmup_steps=warmup_steps, total_steps=total_steps),
+                                                 last_epoch=start_step - 1)
+    return torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=patience, verbose=True)
+
+def steps_per_batch(scheduler):
+    """ True if the scheduler steps on each optimizer step, False if on the validation loss """
+    return not isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau)
@@ -21,7 +21,8 @@ cudnn.enabled = True
 import cv2
 import torchvision.transforms.transforms as transforms
 
-from model.model import Mini_Xception
+from model.inference import load_model, compile_model, BACKENDS
+from mixed_precision import AMP_MODES, check_amp, autocast
 from dataset import FER2013
 from utils import get_label_emotion
 
@@ -32,6 +33,9 @@ def parse_args():
     parser.add_argument('--resume', action='store_true', help='resume from pretrained path specified in prev arg')
     parser.add_argument('--mode', type=str, choices=['train', 'test', 'val'], default='test', help='dataset mode')    
     parser.add_argument('--pretrained', type=str,default='checkpoint/model_weights/train_original.pth.tar')
+    parser.add_argument('--compile', type=str, default='eager', choices=BACKENDS, help='eager model, TorchScript (cached next to the checkpoint) or torch.compile')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory layout')
+    parser.add_argument('--amp', type=str, default='', choices=AMP_MODES, help='mixed precision inference, bf16 (CPU & recent GPUs) or fp16 (GPU)')
     args = parser.parse_args()
     return args
 # ======================================================================
@@ -40,12 +44,10 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 args = parse_args()
 
 def main():
-    mini_xception = Mini_Xception()
-    mini_xception.to(device)
-    mini_xception.eval()
-
-    checkpoint = torch.load(args.pretrained, map_location=device)
-    mini_xception.load_state_dict(checkpoint['mini_xception'], strict=False)
+    check_amp(args.amp, device)
+    # training checkpoint or BatchNorm folded one from export.py
+    mini_xception = load_model(args.pretrained, num_classes=7, device=device)
+    mini_xception = compile_model(mini_xception, args.pretrained, args.compile, args.channels_last, device)
     print(f'\tLoaded checkpoint from {args.pretrained}\n')
 
     dataset = FER2013(args.datapath, args.mode, transform=transforms.ToTensor())
@@ -58,7 +60,8 @@ def main():
 
             face = face.to(device)
             face = torch.unsqueeze(face, 0)
-            emotion = mini_xception(face)
+            with autocast(args.amp, device):
+                emotion = mini_xception(face)
 
             # torch.set_printoptions(precision=6)
             # softmax = nn.Softmax()
@@ -3,260 +3,954 @@ Author: Amr Elsersy
 email: amrelsersay@gmail.com
 -----------------------------------------------------------------------------------
 Description: Training & Validation
+
+    python train.py --batch_size 64 ...                               command line
+    Trainer(training_config(batch_size=64, epochs=5)).fit()           python (nothing runs at import)
 """
 import numpy as np 
 import argparse, cv2
 import logging
 import time
 import os
+import copy
+import queue
+import traceback
+from contextlib import nullcontext
 from tqdm import tqdm
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim
 import torch.utils.tensorboard as tensorboard
 import torch.backends.cudnn as cudnn
-from torchvision import datasets, transforms
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Subset
+from torchvision import transforms
 
 import utils
-from model.model import Mini_Xception
-from dataset import create_train_dataloader, create_val_dataloader, create_test_dataloader
+from model.model import Mini_Xception_MultiHead, ARCHITECTURES, POOLS, build_model
+from dataset import create_train_dataloader, create_val_dataloader, create_test_dataloader, FER2013, ResidentLoader
+from dataset import MultiTaskDataset, DistillationDataset
+from dataset import create_image_folder_dataset, create_dataloader, default_num_workers, stratified_subset
+from datastore import ensure_fer2013_store
+from augmentation import BatchAugmentation
+from distillation import DistillationLoss, cached_teacher_logits
+from mixed_precision import AMP_MODES, check_amp, autocast, create_grad_scaler
+from model.quantization import QUANTIZED_BACKENDS, prepare_qat, convert_qat, save_int8, int8_path
+from metrics import ConfusionMatrix
+from distributed import init_distributed, is_main_process, get_rank, get_world_size, get_local_rank, local_threads
+from distributed import main_process_first, all_reduce_sum, scale_lr, set_epoch, cleanup
+from checkpoint import CheckpointManager, rng_state, set_rng_state, to_cpu
+from schedules import SCHEDULES, create_scheduler, optimizer_steps, steps_per_batch
+from profiling import NullProfiler, create_profiler
+from metrics_log import MetricsLog
 from utils import visualize_confusion_matrix
-from sklearn.metrics import precision_score, recall_score, accuracy_score, confusion_matrix
 
 cudnn.benchmark = True
 cudnn.enabled = True
 
-def parse_args():
+def parse_args(argv=None):
+    """ training arguments of the command line (argv = None) or of an argv list, e.g. parse_args(['--epochs', '5']) """
     parser = argparse.ArgumentParser()
     parser.add_argument('--epochs', type=int, default=300, help='num of training epochs')
     parser.add_argument('--batch_size', type=int, default=15, help="training batch size")
     parser.add_argument('--tensorboard', type=str, default='checkpoint/tensorboard', help='path log dir of tensorboard')
     parser.add_argument('--logging', type=str, default='checkpoint', help='path of logging')
-    parser.add_argument('--lr', type=float, default=0.001, help='learning rate')
+    parser.add_argument('--lr', type=float, default=0.001, help='learning rate of --base_batch, scaled by --lr_scaling to the effective batch')
     parser.add_argument('--weight_decay', type=float, default=1e-6, help='optimizer weight decay')
     parser.add_argument('--datapath', type=str, default='data', help='root path of dataset')
     parser.add_argument('--test_datapath', type=str, default='data', help='root path of test dataset')
     parser.add_argument('--pretrained', type=str,default='checkpoint/model_weights/train_original.pth.tar',help='load checkpoint')
     parser.add_argument('--resume', action='store_true', help='resume from pretrained path specified in prev arg')
+    parser.add_argument('--finetune', action='store_true', help='init from the pretrained weights & train from epoch 0 with a fresh optimizer')
     parser.add_argument('--savepath', type=str, default='checkpoint/model_weights', help='save checkpoint path')    
     parser.add_argument('--savefreq', type=int, default=1, help="save weights each freq num of epochs")
+    parser.add_argument('--keep_last', type=int, default=3, help='checkpoints of the last epochs kept, the older ones are deleted')
+    parser.add_argument('--keep_best', type=int, default=3, help='checkpoints of the best validation accuracies kept as well')
     parser.add_argument('--logdir', type=str, default='checkpoint/logging', help='logging')
     parser.add_argument("--lr_patience", default=40, type=int)
+    parser.add_argument('--schedule', type=str, default='plateau', choices=SCHEDULES, help='lr schedule: plateau on the val loss, onecycle or cosine with warmup over --epochs (see schedules.py)')
+    parser.add_argument('--warmup_epochs', type=float, default=0, help='linear lr warmup of cosine (& onecycle, 30 %% of the run by default)')
+    parser.add_argument('--accumulate', type=int, default=1, help='batches of gradients accumulated per optimizer step (effective batch = batch_size x accumulate x processes)')
+    parser.add_argument('--base_batch', type=int, default=0, help='batch size --lr is tuned for, 0 = --batch_size (only the processes & --accumulate scale it)')
+    parser.add_argument('--target_accuracy', type=float, default=0, help='stop once the validation accuracy reaches it (e.g. 0.65) & report the time to reach it, 0 = off')
     parser.add_argument('--evaluate', action='store_true', help='evaluation only')
     parser.add_argument('--mode', type=str, default='val', choices=['val','test', 'train'], help='dataset type for evaluation only')
     parser.add_argument('--age_mode', action='store_true', help='age mode')
+    parser.add_argument('--arch', type=str, default='Mini_Xception', choices=list(ARCHITECTURES.keys()), help='model architecture (see model.model.ARCHITECTURES)')
+    parser.add_argument('--stem', type=int, default=None, help='channels of the stem convs (default: the --arch one)')
+    parser.add_argument('--blocks', type=int, nargs='+', default=None, help='output channels of each residual block (default: the --arch ones)')
+    parser.add_argument('--pool', type=str, default=None, choices=POOLS, help='pooling of the residual blocks (default: the --arch one)')
+    parser.add_argument('--head', type=int, nargs='*', default=None, help='channels of the head convs before the classifier (default: the --arch ones)')
+    parser.add_argument('--mid', type=int, nargs='+', default=None, help='channels between the separable convs of each block (default: the block outputs)')
+    parser.add_argument('--prefix', type=str, default='', help='prefix of the log & checkpoint names')
+    parser.add_argument('--joint', action='store_true', help='train the shared backbone emotion + age model on --datapath emotions & --age_datapath ages')
+    parser.add_argument('--age_datapath', type=str, default='dataset_age', help='ImageFolder root (Train / Test) of the ages for --joint')
+    parser.add_argument('--teachers', type=str, nargs='+', default=None, help='distill from these frozen checkpoints (checkpoint or checkpoint:Arch, e.g. custom_models/y_52_....pth.tar:Mini_Yception)')
+    parser.add_argument('--temperature', type=float, default=4.0, help='softening temperature of the distillation')
+    parser.add_argument('--distill_alpha', type=float, default=0.7, help='weight of the teacher loss, 1 - alpha for the labels')
+    parser.add_argument('--teacher_cache', type=str, default='checkpoint/teacher_logits', help='cache dir of the teacher logits of each training sample')
+    parser.add_argument('--batch_augment', action='store_true', help='equalize & augment whole uint8 batches with torch ops')
+    parser.add_argument('--aug_flip', type=float, default=0.5, help='horizontal flip probability (batch_augment)')
+    parser.add_argument('--aug_rotation', type=int, default=0, help='max random rotation in degrees, 0 = off (batch_augment)')
+    parser.add_argument('--aug_crop', type=int, default=0, help='random crop size resized back to input size, 0 = off (batch_augment)')
+    parser.add_argument('--preprocess', action='store_true', help='bake grayscale & equalization into the dataset stores once (see datastore.py)')
+    parser.add_argument('--resident', action='store_true', help='keep the whole dataset in one tensor & batch by index permutation (implies --batch_augment)')
+    parser.add_argument('--num_workers', type=int, default=default_num_workers(), help='DataLoader worker processes (default: cores - 1, max 8)')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched by each worker')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep the DataLoader workers alive between epochs')
+    parser.add_argument('--pin_memory', action='store_true', help='pin batches in page locked memory for faster host to GPU copies')
+    parser.add_argument('--drop_last', action='store_true', help='drop the last incomplete training batch')
+    parser.add_argument('--val_every', type=int, default=1, help='validate every n epochs (& after the last one), the lr scheduler steps on each validation')
+    parser.add_argument('--val_subsample', type=float, default=0, help='validate on this stratified fraction of the validation set, except after the last epoch (0 = full set)')
+    parser.add_argument('--async_val', action='store_true', help='validate the weights of each epoch in a worker process while the next epoch trains')
+    parser.add_argument('--val_threads', type=int, default=2, help='torch threads of the --async_val worker')
+    parser.add_argument('--log_interval', type=int, default=50, help='steps between the loss updates of the progress bar (the only host syncs of the loop), 0 = off')
+    parser.add_argument('--profile', action='store_true', help='torch.profiler window of the first training epoch & validation, traces in --tensorboard (see profiling.py)')
+    parser.add_argument('--profile_wait', type=int, default=1, help='steps skipped before the --profile window')
+    parser.add_argument('--profile_warmup', type=int, default=1, help='warmup steps of the --profile window, not recorded')
+    parser.add_argument('--profile_steps', type=int, default=5, help='steps recorded by --profile')
+    parser.add_argument('--profile_top', type=int, default=15, help='operators of the printed --profile summary')
+    parser.add_argument('--amp', type=str, default='', choices=AMP_MODES, help='mixed precision: bf16 (CPU & recent GPUs) or fp16 (GPU, with loss scaling)')
+    parser.add_argument('--amp_tolerance', type=float, default=0.01, help='max accuracy drop of --amp vs float32, checked after training & in --evaluate')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'], help='process group backend when launched by torchrun')
+    parser.add_argument('--lr_scaling', type=str, default='linear', choices=['linear', 'sqrt', 'none'], help='lr scaling with the effective batch / --base_batch')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per process, 0 = cores / local processes when distributed, torch default otherwise')
+    parser.add_argument('--qat', action='store_true', help='quantization aware training, int8 models are saved next to the checkpoints (use with --finetune)')
+    parser.add_argument('--qbackend', type=str, default='fbgemm', choices=QUANTIZED_BACKENDS, help='quantized backend of --qat, fbgemm (x86) or qnnpack (ARM)')
+
+    args = parser.parse_args(argv)
+    if args.joint and args.teachers:
+        parser.error('--teachers is not supported with --joint')
+    # resident batches are raw uint8, augmentation has to run on the batch
+    if args.resident:
+        args.batch_augment = True
+    return args
 
-    args = parser.parse_args()
+def training_config(**overrides):
+    """ the train.py arguments with the given ones replaced, e.g. training_config(epochs=5, lr=0.01, resident=True) """
+    args = parse_args([])
+    for key, value in overrides.items():
+        if not hasattr(args, key):
+            raise TypeError(f'unknown training argument {key}')
+        setattr(args, key, value)
+    if args.joint and args.teachers:
+        raise ValueError('teachers is not supported with joint')
+    if args.resident:
+        args.batch_augment = True
     return args
-# ======================================================================
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-args = parse_args()
-# logging
-logging.basicConfig(
-format='[%(message)s',
-level=logging.INFO,
-handlers=[logging.FileHandler(args.logdir + "_" +
-                              args.datapath.split("/")[-1] + "_" +
-                              str(args.batch_size) + "_" +
-                              str(args.lr) + "_" +
-                              str(args.lr_patience) + "_" +
-                              str(args.weight_decay), mode='w'), logging.StreamHandler()])
-# tensorboard
-writer = tensorboard.SummaryWriter(args.tensorboard)
-
-transform = transforms.Compose([transforms.Grayscale(num_output_channels=1),
-                                transforms.RandomEqualize(p=1),
-                                # transforms.ToPILImage(),
-                                transforms.RandomHorizontalFlip(p=0.5),
-                                transforms.ToTensor()])
-
-def main():
-    # ========= dataloaders ===========
-    if args.datapath == "data":
-        train_dataloader = create_train_dataloader(root=args.datapath, batch_size=args.batch_size)
-        test_dataloader = create_val_dataloader(root=args.datapath, batch_size=args.batch_size)
-    else:
-        trainDataset = datasets.ImageFolder(args.datapath + "/Train", transform=transform)
-        print(trainDataset.class_to_idx)
-        train_dataloader = torch.utils.data.DataLoader(trainDataset, batch_size=args.batch_size, shuffle=True)
 
-        if args.test_datapath == "data":
-            test_dataloader = create_val_dataloader(root="data", batch_size=args.batch_size)
-        else:
-            testDataset = datasets.ImageFolder(args.test_datapath + "/Test", transform=transform)
-            test_dataloader = torch.utils.data.DataLoader(testDataset, batch_size=args.batch_size, shuffle=True)
-
-    # train_dataloader, test_dataloader = create_CK_dataloader(batch_size=args.batch_size)
-    start_epoch = 0
-    # ======== models & loss ==========
-    if args.age_mode:
-        mini_xception = Mini_Xception(5)
-    else:
-        mini_xception = Mini_Xception()
-
-    loss = nn.CrossEntropyLoss()
-    # ========= load weights ===========
-    if args.resume or args.evaluate:
-        checkpoint = torch.load(args.pretrained, map_location=device)
-        mini_xception.load_state_dict(checkpoint['mini_xception'], strict=False)
-        start_epoch = checkpoint['epoch'] + 1
-        print(f'\tLoaded checkpoint from {args.pretrained}\n')
-        time.sleep(1)
+def run_name(args):
+    """ hyperparameters in the log & checkpoint names """
+    return (args.datapath.split("/")[-1] + "_" +
+            str(args.batch_size) + "_" +
+            str(args.lr) + "_" +
+            str(args.lr_patience) + "_" +
+            str(args.weight_decay))
+
+def log_path(args):
+    """ text log of the run, its JSONL metrics log is log_path + '.jsonl' """
+    return args.logdir + (f"_{args.prefix}_" if args.prefix else "_") + run_name(args)
+
+def create_logger(args):
+    """ 'train' logger to the log file of the run & the console, only warnings on the ranks other than 0 """
+    logger = logging.getLogger('train')
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    if is_main_process():
+        logger.setLevel(logging.INFO)
+        fmt = '[%(message)s'
+        handlers = [logging.FileHandler(log_path(args), mode='w'),
+                    logging.StreamHandler()]
     else:
-        print("******************* Start training from scratch *******************\n")
-        time.sleep(2)
+        logger.setLevel(logging.WARNING)
+        fmt = f'[rank {get_rank()}] %(message)s'
+        handlers = [logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(fmt))
+        logger.addHandler(handler)
+    return logger
+
+def image_transform(batch_augment=False, size=None):
+    """ per sample transform of the ImageFolder datasets, size: faces resized to size x size (None = native size) """
+    # resized before the equalization, like the packed stores & camera_demo.py
+    resize = [transforms.Resize((size, size))] if size else []
+    # batch_augment: ImageFolder samples stay uint8, equalization & flip are done on the batch
+    if batch_augment:
+        return transforms.Compose([transforms.Grayscale(num_output_channels=1), *resize,
+                                   transforms.PILToTensor()])
+    return transforms.Compose([transforms.Grayscale(num_output_channels=1), *resize,
+                               transforms.RandomEqualize(p=1),
+                               # transforms.ToPILImage(),
+                               transforms.RandomHorizontalFlip(p=0.5),
+                               transforms.ToTensor()])
+
+# heads of Mini_Xception_MultiHead in --joint mode
+TASKS = ['emotion', 'age']
+
+def masked_cross_entropy(outputs, labels):
+    """ cross entropy averaged over the labeled samples only (label -1 = missing), 0 if there is none """
+    mask = labels >= 0
+    loss = F.cross_entropy(outputs, labels.clamp(min=0), reduction='none')
+    return (loss * mask).sum() / mask.sum().clamp(min=1)
+
+class JointLoss(nn.Module):
+    """ sum over the heads of the masked cross entropy, labels (batch, heads) """
+    def forward(self, outputs, labels):
+        batch = labels.shape[0]
+        return sum(masked_cross_entropy(output.reshape(batch, -1), labels[:, i]) for i, output in enumerate(outputs))
+
+def equalize_mode(dataset):
+    """ equalization the batch augmentation has to do for this dataset (None if already baked) """
+    if isinstance(dataset, (DistillationDataset, Subset)):
+        return equalize_mode(dataset.dataset)
+    if isinstance(dataset, MultiTaskDataset):
+        modes = set(equalize_mode(d) for d in dataset.datasets)
+        if len(modes) > 1:
+            raise ValueError(f'--batch_augment can not mix equalizations {modes}, bake them with --preprocess')
+        return modes.pop()
+    if getattr(dataset, 'equalized', False):
+        return None
+    # FER2013 is equalized with cv2, ImageFolder datasets with PIL (RandomEqualize)
+    return 'cv2' if isinstance(dataset, FER2013) else 'pil'
+
+def to_device(labels, device):
+    """ labels, or tuple of labels & teacher logits (--teachers), on the training device """
+    if isinstance(labels, (tuple, list)):
+        return tuple(label.to(device, non_blocking=True) for label in labels)
+    return labels.to(device, non_blocking=True)
+
+def mean_loss(total_loss, step):
+    """ mean of the summed batch losses, over the batches of all the processes when distributed """
+    total = all_reduce_sum(torch.stack([total_loss.float(), torch.tensor(float(step), device=total_loss.device)]))
+    return (total[0] / total[1].clamp(min=1)).item()
+
+def show_metrics(metrics, name=''):
+    """ per class precision / recall & the normalized confusion matrix (--evaluate) """
+    precision, recall = metrics.per_class()
+    for label in metrics.present().tolist():
+        print(f'{name} class {label} .. Percision = {round(precision[label].item(), 3)} .. Recall = {round(recall[label].item(), 3)}')
+    conf_matrix = metrics.normalized()
+    print(f'{name} Confusion Matrix\n'.lstrip(), conf_matrix)
+    visualize_confusion_matrix(conf_matrix, conf_matrix.shape[0])
 
-    if args.evaluate:
-        if args.test_datapath == "data":
+# ======================================================================
+class Trainer:
+    """
+    Training & validation of one run configured by the train.py arguments (parse_args / training_config).
+    The process group, logs & tensorboard are created by the Trainer (not at import), so train.py can be
+    imported by DataLoader workers (spawn), sweeps & benchmarks. fit() returns the metrics of each epoch.
+    """
+    def __init__(self, args, worker=False):
+        """ worker: validation worker of --async_val, no process group, log file nor tensorboard """
+        self.args = args
+        self.worker = worker
+        # torchrun: one process per rank, each on its shard of the data
+        self.distributed = False if worker else init_distributed(args.dist_backend)
+        if self.distributed and args.async_val:
+            raise ValueError('--async_val is not supported in distributed training, the ranks validate their shards')
+        self.device = torch.device(f"cuda:{get_local_rank()}" if torch.cuda.is_available() else "cpu")
+        if worker:
+            torch.set_num_threads(args.val_threads)
+        elif args.threads or self.distributed:
+            torch.set_num_threads(args.threads or local_threads())
+        check_amp(args.amp, self.device)
+        # logging, tensorboard & checkpoints from rank 0 only
+        self.logger = logging.getLogger('train.validation') if worker else create_logger(args)
+        self.writer = tensorboard.SummaryWriter(args.tensorboard) if is_main_process() and not worker else None
+        self.transform = image_transform(args.batch_augment)
+        # loops already profiled by --profile
+        self.profiled = set()
+        # background checkpoint writer & JSONL metrics log of fit() (rank 0)
+        self.checkpoints = None
+        self.metrics_log = None
+
+    # ========= datasets & dataloaders ===========
+    def image_folder_dataset(self, folder, size=None):
+        """ packed store of the ImageFolder root if there is one (built when --preprocess), else ImageFolder resized to size """
+        store_transform = None if self.args.batch_augment else utils.get_transforms()
+        transform = image_transform(self.args.batch_augment, size) if size else self.transform
+        return create_image_folder_dataset(folder, transform, store_transform, self.args.preprocess)
+
+    def joint_dataset(self, train=True):
+        """ emotions of --datapath (FER2013 or ImageFolder) & ages of --age_datapath in one MultiTaskDataset """
+        args = self.args
+        # the batches mix both datasets, the ImageFolder faces are resized to the 48 x 48 of FER2013 & the stores
+        size = 48
+        split = 'Train' if train else 'Test'
+        if args.datapath == "data":
+            fer_transform = None
+            if not args.batch_augment:
+                fer_transform = utils.get_transforms() if train else transforms.ToTensor()
+            emotion = FER2013(args.datapath, 'train' if train else 'val', fer_transform)
+        else:
+            emotion = self.image_folder_dataset(os.path.join(args.datapath, split), size)
+        age = self.image_folder_dataset(os.path.join(args.age_datapath, split), size)
+        return MultiTaskDataset([emotion, age])
+
+    def loader_options(self, train=True):
+        """ create_dataloader options of the arguments, drop_last only applies to training """
+        args = self.args
+        return dict(num_workers=args.num_workers, pin_memory=args.pin_memory, prefetch_factor=args.prefetch_factor,
+                    persistent_workers=args.persistent_workers, drop_last=args.drop_last and train,
+                    batch_augment=args.batch_augment, distributed=self.distributed, pad_shards=train)
+
+    def resident_loader(self, dataset, shuffle=False):
+        """ ResidentLoader of this process (its shard when distributed, padded for training only) """
+        return ResidentLoader(dataset, self.args.batch_size, shuffle=shuffle, device=self.device, rank=get_rank(), world_size=get_world_size(),
+                              pad=shuffle)
+
+    def create_augmentations(self, train_dataset, val_dataset):
+        """ returns (train, val) BatchAugmentation, or (None, None) for the per sample transforms """
+        args = self.args
+        if not args.batch_augment:
+            return None, None
+        train_augment = BatchAugmentation(equalize_mode(train_dataset), args.aug_flip, args.aug_rotation, args.aug_crop)
+        val_augment = BatchAugmentation(equalize_mode(val_dataset)).eval()
+        return train_augment, val_augment
+
+    def create_dataloaders(self):
+        """ (train, validation) loaders """
+        args = self.args
+        if args.preprocess and "data" in [args.datapath, args.test_datapath]:
+            ensure_fer2013_store("data", equalize='cv2')
+
+        if args.joint:
+            train_dataloader = create_dataloader(self.joint_dataset(), args.batch_size, shuffle=True, **self.loader_options())
+        elif args.datapath == "data":
+            train_dataloader = create_train_dataloader(root=args.datapath, batch_size=args.batch_size, **self.loader_options())
+        else:
+            trainDataset = self.image_folder_dataset(args.datapath + "/Train")
+            if is_main_process():
+                print(trainDataset.class_to_idx)
+            train_dataloader = create_dataloader(trainDataset, args.batch_size, shuffle=True, **self.loader_options())
+
+        # train_dataloader, test_dataloader = create_CK_dataloader(batch_size=args.batch_size)
+        if args.teachers:
+            # teacher logits of each training sample, computed on the first run only
+            train_dataset = train_dataloader.dataset
+            logits = cached_teacher_logits(args.teachers, train_dataset, 5 if args.age_mode else 7, equalize_mode(train_dataset),
+                                           args.teacher_cache, self.device)
+            train_dataloader = create_dataloader(DistillationDataset(train_dataset, logits), args.batch_size, shuffle=True, **self.loader_options())
+        if args.resident:
+            train_dataloader = self.resident_loader(train_dataloader.dataset, shuffle=True)
+        return train_dataloader, self.create_validation_dataloader()
+
+    def create_validation_dataloader(self):
+        """ validation loader of the training: FER2013 PrivateTest or the Test split of --test_datapath (both tasks with --joint) """
+        args = self.args
+        if args.joint:
+            test_dataloader = create_dataloader(self.joint_dataset(False), args.batch_size, **self.loader_options(False))
+        elif args.datapath == "data" or args.test_datapath == "data":
+            test_dataloader = create_val_dataloader(root="data", batch_size=args.batch_size, **self.loader_options(False))
+        else:
+            testDataset = self.image_folder_dataset(args.test_datapath + "/Test")
+            test_dataloader = create_dataloader(testDataset, args.batch_size, shuffle=True, **self.loader_options(False))
+        if args.resident:
+            test_dataloader = self.resident_loader(test_dataloader.dataset)
+        return test_dataloader
+
+    def create_subsample_dataloader(self, dataloader):
+        """ loader of the stratified --val_subsample of a validation loader, None when off """
+        args = self.args
+        if not args.val_subsample:
+            return None
+        subset = stratified_subset(dataloader.dataset, args.val_subsample)
+        if args.resident:
+            return self.resident_loader(subset)
+        return create_dataloader(subset, args.batch_size, **self.loader_options(False))
+
+    def create_evaluate_dataloader(self):
+        """ loader of the --mode split for --evaluate """
+        args = self.args
+        if args.joint:
+            test_dataloader = create_dataloader(self.joint_dataset(args.mode == 'train'), args.batch_size, **self.loader_options(False))
+        elif args.test_datapath == "data":
+            if args.preprocess:
+                ensure_fer2013_store("data", equalize='cv2')
             if args.mode == 'test':
-                test_dataloader = create_test_dataloader(args.test_datapath, batch_size=args.batch_size)
+                test_dataloader = create_test_dataloader(args.test_datapath, batch_size=args.batch_size, **self.loader_options(False))
             elif args.mode == 'val':
-                test_dataloader = create_val_dataloader(args.test_datapath, batch_size=args.batch_size)
+                test_dataloader = create_val_dataloader(args.test_datapath, batch_size=args.batch_size, **self.loader_options(False))
             else:
-                test_dataloader = create_train_dataloader(args.test_datapath, batch_size=args.batch_size)
+                test_dataloader = create_train_dataloader(args.test_datapath, batch_size=args.batch_size, **self.loader_options(False))
         else:
-            if args.mode == 'val':
-                testDataset = datasets.ImageFolder(args.test_datapath + "/Test", transform=transform)
-                test_dataloader = torch.utils.data.DataLoader(testDataset, batch_size=args.batch_size, shuffle=True)
-            elif args.mode == 'train':
-                testDataset = datasets.ImageFolder(args.test_datapath + "/Train", transform=transform)
-                test_dataloader = torch.utils.data.DataLoader(testDataset, batch_size=args.batch_size, shuffle=True)
-
-        validate(mini_xception, loss, test_dataloader, 0)
-        return
-
-    # =========== optimizer =========== 
-    # parameters = mini_xception.named_parameters()
-    # for name, p in parameters:
-    #     print(p.requires_grad, name)
-    # return
-    optimizer = torch.optim.Adam(mini_xception.parameters(), lr=args.lr, weight_decay=args.weight_decay)
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=args.lr_patience, verbose=True)
+            # ImageFolder roots only have Train & Test
+            split = "/Train" if args.mode == 'train' else "/Test"
+            testDataset = self.image_folder_dataset(args.test_datapath + split)
+            test_dataloader = create_dataloader(testDataset, args.batch_size, shuffle=True, **self.loader_options(False))
+        if args.resident:
+            test_dataloader = self.resident_loader(test_dataloader.dataset)
+        return test_dataloader
+
+    # ======== model & loss ==========
+    def create_model(self):
+        """ (arch, model on the device, start epoch, --resume checkpoint) with the --finetune / --resume / --evaluate weights """
+        args = self.args
+        start_epoch = 0
+        checkpoint = None
+        if args.joint:
+            arch = 'Mini_Xception_MultiHead'
+            mini_xception = Mini_Xception_MultiHead((7, 5))
+        else:
+            arch = args.arch
+            # checkpoints of configured models (pruned, swept) rebuild their own config, the CLI can still change it
+            config = {}
+            if args.finetune or args.resume or args.evaluate:
+                config = torch.load(args.pretrained, map_location='cpu').get('config') or {}
+            config.update({key: value for key, value in dict(stem=args.stem, blocks=args.blocks, pool=args.pool,
+                                                             head=args.head, mid=args.mid).items() if value is not None})
+            mini_xception = build_model(args.arch, 5 if args.age_mode else 7, **config)
+
+        # ========= load weights ===========
+        if args.finetune:
+            checkpoint = torch.load(args.pretrained, map_location='cpu')
+            # --joint: the shared backbone can come from a single task Mini_Xception checkpoint
+            mini_xception.load_state_dict(checkpoint['mini_xception'], strict=not args.joint)
+            print(f'\tFine tuning from {args.pretrained}\n')
+        # fake quantization after the float weights, --resume / --evaluate then expect a --qat checkpoint
+        if args.qat:
+            mini_xception = prepare_qat(mini_xception, args.qbackend)
+        mini_xception.to(self.device)
+
+        if args.resume or args.evaluate:
+            checkpoint = torch.load(args.pretrained, map_location=self.device)
+            mini_xception.load_state_dict(checkpoint['mini_xception'], strict=False)
+            start_epoch = checkpoint['epoch'] + 1
+            print(f'\tLoaded checkpoint from {args.pretrained}\n')
+        elif not args.finetune:
+            print("******************* Start training from scratch *******************\n")
+        return arch, mini_xception, start_epoch, checkpoint if args.resume else None
+
+    def criterion(self):
+        return JointLoss() if self.args.joint else nn.CrossEntropyLoss()
+
+    def validate_fn(self):
+        return self.validate_joint if self.args.joint else self.validate
+
     # ========================================================================
-    for epoch in range(start_epoch, args.epochs):
-        # =========== train / validate ===========
-        train_loss = train_one_epoch(mini_xception, loss, optimizer, train_dataloader, epoch)
-        val_loss, accuracy, percision, recall = validate(mini_xception, loss, test_dataloader, epoch)
-        scheduler.step(val_loss)
+    def run(self):
+        """ what the command line asks for: evaluate() with --evaluate, else fit() """
+        try:
+            return self.evaluate() if self.args.evaluate else self.fit()
+        finally:
+            self.close()
+
+    def evaluate(self):
+        """ validation metrics of the --pretrained checkpoint on the --mode split """
+        args = self.args
+        _, mini_xception, _, _ = self.create_model()
+        # rank 0 builds the stores, the other ranks then read them
+        with main_process_first():
+            test_dataloader = self.create_evaluate_dataloader()
+        _, val_augment = self.create_augmentations(test_dataloader.dataset, test_dataloader.dataset)
+        if args.amp:
+            return self.compare_amp(mini_xception, self.criterion(), test_dataloader, val_augment)
+        return self.validate_fn()(mini_xception, self.criterion(), test_dataloader, 0, val_augment)
+
+    def fit(self):
+        """ trains for --epochs, returns the list of the metrics of each epoch """
+        args = self.args
+        device = self.device
+        # ========= dataloaders ===========
+        # rank 0 builds the stores & the teacher logits cache, the other ranks then read them
+        with main_process_first():
+            train_dataloader, test_dataloader = self.create_dataloaders()
+        train_augment, val_augment = self.create_augmentations(train_dataloader.dataset, test_dataloader.dataset)
+        # ======== models & loss ==========
+        arch, mini_xception, start_epoch, resume_checkpoint = self.create_model()
+        # saved in the checkpoints to rebuild the model (model.inference.load_model)
+        config = getattr(mini_xception, 'config', None)
+        # the gradients are averaged over the processes, mini_xception stays the module that is saved & validated
+        train_model = DistributedDataParallel(mini_xception) if self.distributed else mini_xception
+
+        loss = self.criterion()
+        validate_fn = self.validate_fn()
+        # validation stays on the labels
+        train_criterion = DistillationLoss(args.temperature, args.distill_alpha) if args.teachers else loss
+
+        # =========== optimizer ===========
+        # parameters = mini_xception.named_parameters()
+        # for name, p in parameters:
+        #     print(p.requires_grad, name)
+        # return
+        # the effective batch is batch_size x accumulate x processes
+        effective_batch = args.batch_size * args.accumulate * get_world_size()
+        lr = scale_lr(args.lr, effective_batch / (args.base_batch or args.batch_size), args.lr_scaling)
+        if effective_batch != args.batch_size:
+            self.logger.info(f'\t{get_world_size()} processes x {args.accumulate} accumulated batches .. effective batch = {effective_batch} .. lr = {lr}')
+        optimizer = torch.optim.Adam(mini_xception.parameters(), lr=lr, weight_decay=args.weight_decay)
+        steps_per_epoch = optimizer_steps(len(train_dataloader), args.accumulate)
+        scheduler = create_scheduler(args.schedule, optimizer, args.epochs, steps_per_epoch, args.warmup_epochs, args.lr_patience)
+        scaler = create_grad_scaler(args.amp, device)
+        if resume_checkpoint:
+            self.load_training_state(resume_checkpoint, optimizer, scheduler, scaler)
+            if steps_per_batch(scheduler) and 'scheduler' in resume_checkpoint:
+                # the schedule of the --epochs of this run, which can be longer (e.g. the rungs of hparam_sweep.py),
+                # only its step comes from the checkpoint
+                scheduler = create_scheduler(args.schedule, optimizer, args.epochs, steps_per_epoch, args.warmup_epochs,
+                                             start_step=resume_checkpoint['scheduler']['last_epoch'])
+        # onecycle & cosine step in train_one_epoch, plateau on the validations
+        batch_scheduler = scheduler if steps_per_batch(scheduler) else None
+        if is_main_process():
+            index = os.path.join(args.savepath, (f'{args.prefix}_' if args.prefix else '') + run_name(args) + '.index.json')
+            self.checkpoints = CheckpointManager(index, args.keep_last, args.keep_best)
+            # a resumed run goes on in the same metrics log
+            self.metrics_log = MetricsLog(log_path(args) + '.jsonl', run_name(args), vars(args), append=args.resume)
+        # the subsample for the intermediate validations, the full set after the last epoch
+        val_loaders = {True: test_dataloader, False: self.create_subsample_dataloader(test_dataloader) or test_dataloader}
+        validator = AsyncValidator(args, mini_xception) if args.async_val else None
+        # ========================================================================
+        history = {}
+        # checkpoint states of the epochs waiting for their --async_val validation
+        pending = {}
+        # first epoch whose validation reached --target_accuracy
+        target_epoch = None
+        # epochs not in the metrics log yet, each one is logged once its validation is back
+        unlogged = []
+
+        def record(val_epoch, result):
+            """ validation result of val_epoch: lr plateau, logs, history, target & its pending checkpoint """
+            nonlocal target_epoch
+            val_loss, accuracy, percision, recall = result
+            if not batch_scheduler:
+                scheduler.step(val_loss)
+            metrics = self.log_validation(val_epoch, val_loss, accuracy, percision, recall)
+            history[val_epoch].update(metrics)
+            if args.target_accuracy and target_epoch is None and metrics['accuracy'] >= args.target_accuracy:
+                target_epoch = val_epoch
+            if val_epoch in pending:
+                checkpoint_state = pending.pop(val_epoch)
+                checkpoint_state['metrics'] = metrics
+                if not batch_scheduler:
+                    # the snapshot was taken before this plateau step, --resume would miss it & its lr drop
+                    checkpoint_state['scheduler'] = to_cpu(scheduler.state_dict())
+                    for group, live_group in zip(checkpoint_state['optimizer']['param_groups'], optimizer.param_groups):
+                        group['lr'] = live_group['lr']
+                self.checkpoints.save(checkpoint_state, self.checkpoint_path(val_epoch), val_epoch, metrics['accuracy'])
+                print(f'\n\t*** Saving checkpoint in {self.checkpoint_path(val_epoch)} ***\n')
+
+        fit_start = time.perf_counter()
+        try:
+            for epoch in range(start_epoch, args.epochs):
+                if target_epoch is not None:
+                    break
+                # =========== train / validate ===========
+                set_epoch(train_dataloader, epoch)
+                start = time.perf_counter()
+                train_loss = self.train_one_epoch(train_model, train_criterion, optimizer, train_dataloader, epoch, train_augment, scaler, batch_scheduler)
+                throughput = len(train_dataloader.dataset) / (time.perf_counter() - start)
+                lr = optimizer.param_groups[0]['lr']
+                self.logger.info(f"\ttraining epoch={epoch} .. train_loss={train_loss} .. {round(throughput, 1)} samples/s .. lr={lr:.3g}")
+                history[epoch] = dict(epoch=epoch, train_loss=train_loss, train_samples_per_sec=throughput, lr=lr)
+                if self.writer:
+                    self.writer.add_scalar('train_loss',train_loss, epoch)
+                    self.writer.add_scalar('train_samples_per_sec', throughput, epoch)
+                    self.writer.add_scalar('lr', lr, epoch)
+
+                last = epoch == args.epochs - 1
+                validated = []
+                if last or (epoch - start_epoch + 1) % args.val_every == 0:
+                    if validator:
+                        validator.submit(epoch, mini_xception, full=last)
+                    else:
+                        validated.append((epoch, validate_fn(mini_xception, loss, val_loaders[last], epoch, val_augment)))
+                # training time up to these weights (the time to --target_accuracy)
+                history[epoch]['epoch_time'] = time.perf_counter() - start
+                history[epoch]['wall_time'] = time.perf_counter() - fit_start
+                unlogged.append(epoch)
+                if validator:
+                    # every validation is back after the last epoch
+                    validated += validator.poll(wait=last)
+
+                # results in epoch order, the ones of --async_val can be from the previous epochs
+                for val_epoch, result in validated:
+                    record(val_epoch, result)
+                unlogged = self.log_metrics(history, unlogged, validator)
+
+                # ============== save model =============
+                if not is_main_process() or epoch % args.savefreq:
+                    continue
+                checkpoint_state = {
+                    'mini_xception': mini_xception.state_dict(),
+                    "epoch": epoch,
+                    'arch': arch,
+                    'config': config,
+                    'qat': args.qat,
+                    # validation of this epoch (e.g. to rank the trials of hparam_sweep.py)
+                    'metrics': {key: history[epoch][key] for key in ['val_loss', 'accuracy', 'percision', 'recall'] if key in history[epoch]},
+                    # what --resume needs to continue exactly where the run stopped
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'scaler': scaler.state_dict(),
+                    'rng': rng_state(),
+                }
+                savepath = self.checkpoint_path(epoch)
+                if validator and validator.is_pending(epoch):
+                    # saved with its metrics once they are back, the weights are copied now
+                    pending[epoch] = to_cpu(checkpoint_state)
+                else:
+                    # written in the background, the next epoch starts right away
+                    self.checkpoints.save(checkpoint_state, savepath, epoch, history[epoch].get('accuracy'))
+                    print(f'\n\t*** Saving checkpoint in {savepath} ***\n')
+                if args.qat:
+                    save_int8(convert_qat(mini_xception), int8_path(savepath), args.qbackend)
+                    print(f'\t*** Saved int8 model in {int8_path(savepath)} ***\n')
+            if validator:
+                # stopped at the target: the validations still running & their checkpoints
+                for val_epoch, result in validator.poll(wait=True):
+                    record(val_epoch, result)
+                self.log_metrics(history, unlogged)
+        finally:
+            if validator:
+                validator.close()
+        self.log_time_to_target(history, target_epoch)
+        if args.amp:
+            self.compare_amp(mini_xception, loss, test_dataloader, val_augment)
+        return [history[epoch] for epoch in sorted(history)]
+
+    def log_metrics(self, history, epochs, validator=None):
+        """ writes the epochs to the metrics log in order up to the first one still validating, returns the others """
+        for i, epoch in enumerate(epochs):
+            if validator and validator.is_pending(epoch):
+                return epochs[i:]
+            if self.metrics_log:
+                self.metrics_log.log_epoch(history[epoch])
+        return []
+
+    def log_time_to_target(self, history, target_epoch):
+        """ training time of the run & the epochs / time it took to reach --target_accuracy """
+        args = self.args
+        if not history:
+            return
+        last = history[max(history)]
+        self.logger.info(f"\ttrained {len(history)} epochs in {round(last['wall_time'], 1)} s")
+        if not args.target_accuracy:
+            return
+        if target_epoch is None:
+            best = max((h['accuracy'] for h in history.values() if 'accuracy' in h), default=0)
+            self.logger.info(f'\ttarget accuracy {args.target_accuracy*100} % not reached .. best accuracy = {best*100} %')
+            return
+        target = history[target_epoch]
+        self.logger.info(f"\ttarget accuracy {args.target_accuracy*100} % reached at epoch {target_epoch} .. "
+                         f"{target_epoch + 1} epochs .. {round(target['wall_time'], 1)} s of training")
+        if self.writer:
+            self.writer.add_scalar('time_to_target', target['wall_time'], target_epoch)
+
+    def checkpoint_path(self, epoch):
+        args = self.args
+        return os.path.join(args.savepath, (f'{args.prefix}_' if args.prefix else '') + f'{epoch}' + "_" + run_name(args) + '.pth.tar')
+
+    def log_validation(self, epoch, val_loss, accuracy, percision, recall):
+        """ logs & tensorboard of the validation of epoch, returns the rounded metrics """
         val_loss, accuracy, percision, recall = round(val_loss,3), round(accuracy,3), round(percision,3), round(recall,3)
-        logging.info(f"\ttraining epoch={epoch} .. train_loss={train_loss}")
-        logging.info(f"\tvalidation epoch={epoch} .. val_loss={val_loss}")
-        logging.info(f'\tAccuracy = {accuracy*100} % .. Percision = {percision*100} % .. Recall = {recall*100} % \n')
-        time.sleep(2)
-        # ============= tensorboard =============
-        writer.add_scalar('train_loss',train_loss, epoch)
-        writer.add_scalar('val_loss',val_loss, epoch)
-        writer.add_scalar('percision',percision, epoch)
-        writer.add_scalar('recall',recall, epoch)
-        writer.add_scalar('accuracy',accuracy, epoch)
-        # ============== save model =============
-        if epoch % args.savefreq == 0:
-            checkpoint_state = {
-                'mini_xception': mini_xception.state_dict(),
-                "epoch": epoch
-            }
-            savepath = os.path.join(args.savepath, f'{epoch}' + "_" +
-                                                   args.datapath.split("/")[-1] + "_" +
-                                                   str(args.batch_size) + "_" +
-                                                   str(args.lr) + "_" +
-                                                   str(args.lr_patience) + "_" +
-                                                   str(args.weight_decay)
-                                                   + '.pth.tar')
-            torch.save(checkpoint_state, savepath)
-            print(f'\n\t*** Saved checkpoint in {savepath} ***\n')
-            time.sleep(2)
-    writer.close()
-
-def train_one_epoch(model, criterion, optimizer, dataloader, epoch):
-    model.train()
-    model.to(device)
-    losses = []
-
-    for images, labels in tqdm(dataloader):
-
-        images = images.to(device) # (batch, 1, 48, 48)
-        labels = labels.to(device) # (batch,)
-        
-        emotions = model(images)
-        # from (batch, 7, 1, 1) to (batch, 7)
-        emotions = torch.squeeze(emotions)
-        # print(emotions)
-        # print(labels,'\n')
-
-        if len(labels) == 1:
-            labels = labels[0]
-
-        loss = criterion(emotions, labels)
-        losses.append(loss.cpu().item())
-        print(f'training @ epoch {epoch} .. loss = {round(loss.item(),3)}')
-
+        self.logger.info(f"\tvalidation epoch={epoch} .. val_loss={val_loss}")
+        self.logger.info(f'\tAccuracy = {accuracy*100} % .. Percision = {percision*100} % .. Recall = {recall*100} % \n')
+        if self.writer:
+            # ============= tensorboard =============
+            self.writer.add_scalar('val_loss',val_loss, epoch)
+            self.writer.add_scalar('percision',percision, epoch)
+            self.writer.add_scalar('recall',recall, epoch)
+            self.writer.add_scalar('accuracy',accuracy, epoch)
+        return dict(val_loss=val_loss, accuracy=accuracy, percision=percision, recall=recall)
+
+    def load_training_state(self, checkpoint, optimizer, scheduler, scaler):
+        """ --resume: optimizer, plateau lr scheduler, loss scaler & RNG states of the checkpoint """
+        if 'optimizer' not in checkpoint:
+            self.logger.warning('\tthe checkpoint only has the weights, the optimizer & lr scheduler restart from scratch')
+            return
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        # onecycle & cosine are rebuilt by fit at the step of the checkpoint
+        if not steps_per_batch(scheduler):
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        set_rng_state(checkpoint['rng'])
+
+    def close(self):
+        """ waits for the checkpoint writes, closes the tensorboard writer, the log files & leaves the process group """
+        if self.checkpoints:
+            self.checkpoints.close()
+            self.checkpoints = None
+        if self.metrics_log:
+            self.metrics_log.close()
+            self.metrics_log = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        cleanup()
+
+    def compare_amp(self, model, criterion, dataloader, augment=None):
+        """ validation in float32 & in --amp, warns if the accuracy drop is over --amp_tolerance """
+        args = self.args
+        validate_fn = self.validate_fn()
+        results = {}
+        for amp in ['', args.amp]:
+            start = time.perf_counter()
+            _, accuracy, _, _ = validate_fn(model, criterion, dataloader, 0, augment, amp)
+            results[amp] = accuracy, len(dataloader.dataset) / (time.perf_counter() - start)
+
+        for amp, (accuracy, throughput) in results.items():
+            self.logger.info(f'\t{amp or "fp32"} .. Accuracy = {round(accuracy*100, 2)} % .. validation {round(throughput, 1)} samples/s')
+        drop = results[''][0] - results[args.amp][0]
+        if drop > args.amp_tolerance:
+            self.logger.warning(f'\t--amp {args.amp} loses {round(drop*100, 2)} % accuracy (tolerance {args.amp_tolerance*100} %)')
+        return drop
+
+    def profiler(self, name):
+        """ --profile: torch profiler of the first train / validation loop (of rank 0), a no-op otherwise """
+        args = self.args
+        if not args.profile or not is_main_process() or self.worker or name in self.profiled:
+            return NullProfiler()
+        self.profiled.add(name)
+        return create_profiler(args.tensorboard, name, args.profile_wait, args.profile_warmup, args.profile_steps, args.profile_top)
+
+    def log_progress(self, progress, step, total_loss, **postfix):
+        """ mean loss in the tqdm postfix every --log_interval steps, .item() waits for the device so not on every step """
+        if self.args.log_interval and step % self.args.log_interval == 0:
+            progress.set_postfix(loss=round(total_loss.item() / step, 3), **postfix)
+
+    def train_one_epoch(self, model, criterion, optimizer, dataloader, epoch, augment=None, scaler=None, scheduler=None):
+        # scheduler: lr schedule stepped after each optimizer step (onecycle / cosine)
+        args = self.args
+        device = self.device
+        model.train()
+        model.to(device)
+        # summed on the device, read back at the log interval & the end of the epoch only
+        total_loss = torch.zeros((), device=device)
+        step = 0
+        # a disabled scaler only calls backward & step
+        scaler = scaler or create_grad_scaler('', device)
+        # --accumulate: the optimizer steps every accumulate batches & on the last one
+        batches = len(dataloader)
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        # images = images.squeeze().cpu().detach().numpy()
-        # cv2.imshow('f', images[0])
-        # cv2.waitKey(0)
-
-    return round(np.mean(losses).item(),3)
-
-
-def validate(model, criterion, dataloader, epoch):
-    model.eval()
-    model.to(device)
-    losses = []
-
-    total_pred = []
-    total_labels = []
-
-    with torch.no_grad():
-        for images, labels in tqdm(dataloader):
-            mini_batch = images.shape[0]
-            images = images.to(device)
-            labels = labels.to(device)
-
-            emotions = model(images)
-            emotions = torch.squeeze(emotions)
-            emotions = emotions.reshape(mini_batch, -1)
-
-            loss = criterion(emotions, labels)
-
-            losses.append(loss.cpu().item())
-
-            # # ============== Evaluation ===============
-            # index of the max value of each sample (shape = (batch,))
-            _, indexes = torch.max(emotions, axis=1)
-            # print(indexes.shape, labels.shape)
-            total_pred.extend(indexes.cpu().detach().numpy())
-            total_labels.extend(labels.cpu().detach().numpy())
-
-            print(f'validation loss = {round(loss.item(),3)}')
-
-        val_loss = np.mean(losses).item()
-        percision = precision_score(total_labels, total_pred, average='macro')
-        recall = recall_score(total_labels, total_pred, average='macro')
-        accuracy = accuracy_score(total_labels, total_pred)
-
-        val_loss, accuracy, percision, recall = round(val_loss,3), round(accuracy,3), round(percision,3), round(recall,3)    
-        print(f'Val loss = {val_loss} .. Accuracy = {accuracy} .. Percision = {percision} .. Recall = {recall}')
-
-        if args.evaluate:
-            conf_matrix = confusion_matrix(total_labels, total_pred, normalize='true')
-            print('Confusion Matrix\n', conf_matrix)
-            if args.age_mode:
-                visualize_confusion_matrix(conf_matrix, 5)
-            else:
-                visualize_confusion_matrix(conf_matrix)
 
+        with self.profiler('train') as profiler:
+            progress = tqdm(dataloader, disable=not is_main_process())
+            for step, (images, labels) in enumerate(progress, 1):
+                update = step % args.accumulate == 0 or step == batches
+                # batches of this optimizer step, fewer in the last group when accumulate does not divide the epoch
+                group = min(args.accumulate, batches - (step - 1) // args.accumulate * args.accumulate)
+                # DDP all-reduces the gradients of the optimizer steps only
+                sync = nullcontext() if update or not hasattr(model, 'no_sync') else model.no_sync()
+
+                images = images.to(device, non_blocking=True) # (batch, 1, 48, 48)
+                labels = to_device(labels, device) # (batch,) or (labels, teacher logits)
+                if augment:
+                    images = augment(images)
+
+                with sync:
+                    with autocast(args.amp, device):
+                        emotions = model(images)
+                        if args.joint or args.teachers:
+                            # head outputs & (batch, heads) labels for JointLoss, (labels, teacher logits) for DistillationLoss
+                            loss = criterion(emotions, labels)
+                        else:
+                            # from (batch, 7, 1, 1) to (batch, 7)
+                            emotions = torch.squeeze(emotions)
+                            # print(emotions)
+                            # print(labels,'\n')
+
+                            if len(labels) == 1:
+                                labels = labels[0]
+
+                            loss = criterion(emotions, labels)
+                    # mean of the accumulated batches
+                    scaler.scale(loss / group).backward()
+                if update:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
+                    if scheduler:
+                        scheduler.step()
+
+                total_loss += loss.detach().float()
+                self.log_progress(progress, step, total_loss, epoch=epoch)
+                profiler.step()
+
+                # images = images.squeeze().cpu().detach().numpy()
+                # cv2.imshow('f', images[0])
+                # cv2.waitKey(0)
+
+        return round(mean_loss(total_loss, step), 3)
+
+    def validate(self, model, criterion, dataloader, epoch, augment=None, amp=None):
+        # amp: precision of this validation, --amp by default
+        args = self.args
+        device = self.device
+        amp = args.amp if amp is None else amp
+        model.eval()
+        model.to(device)
+        total_loss = torch.zeros((), device=device)
+        step = 0
+
+        # confusion matrix on the device, sized on the first batch by the model outputs
+        metrics = None
+
+        with torch.no_grad(), self.profiler('validation') as profiler:
+            progress = tqdm(dataloader, disable=not is_main_process() or self.worker)
+            for step, (images, labels) in enumerate(progress, 1):
+                mini_batch = images.shape[0]
+                images = images.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                if augment:
+                    images = augment(images)
+
+                with autocast(amp, device):
+                    emotions = model(images)
+                emotions = torch.squeeze(emotions.float())
+                emotions = emotions.reshape(mini_batch, -1)
+
+                loss = criterion(emotions, labels)
+                total_loss += loss
+
+                # # ============== Evaluation ===============
+                # index of the max value of each sample (shape = (batch,))
+                _, indexes = torch.max(emotions, axis=1)
+                if metrics is None:
+                    metrics = ConfusionMatrix(emotions.shape[1], device)
+                metrics.update(indexes, labels)
+                self.log_progress(progress, step, total_loss)
+                profiler.step()
+
+            val_loss = mean_loss(total_loss, step)
+            # confusion matrix of the whole validation set (sum of the shards)
+            all_reduce_sum(metrics.matrix)
+            accuracy, percision, recall = metrics.compute()
+
+            val_loss, accuracy, percision, recall = round(val_loss,3), round(accuracy,3), round(percision,3), round(recall,3)
+            if is_main_process() and not self.worker:
+                print(f'Val loss = {val_loss} .. Accuracy = {accuracy} .. Percision = {percision} .. Recall = {recall}')
+
+            # only for the run in the --amp precision when compare_amp validates in both
+            if args.evaluate and amp == args.amp and is_main_process():
+                show_metrics(metrics)
+
+            return val_loss, accuracy, percision, recall
+
+    def validate_joint(self, model, criterion, dataloader, epoch, augment=None, amp=None):
+        """ validate of the multi head model (--joint), metrics of each head over the samples labeled for its task """
+        args = self.args
+        device = self.device
+        amp = args.amp if amp is None else amp
+        model.eval()
+        model.to(device)
+        total_loss = torch.zeros((), device=device)
+        step = 0
+
+        # confusion matrix of each head, the samples without a label for its task are ignored
+        task_metrics = None
+
+        with torch.no_grad(), self.profiler('validation') as profiler:
+            progress = tqdm(dataloader, disable=not is_main_process() or self.worker)
+            for step, (images, labels) in enumerate(progress, 1):
+                mini_batch = images.shape[0]
+                images = images.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                if augment:
+                    images = augment(images)
+
+                with autocast(amp, device):
+                    outputs = model(images)
+                outputs = tuple(output.float() for output in outputs)
+                loss = criterion(outputs, labels)
+                total_loss += loss
+
+                outputs = [output.reshape(mini_batch, -1) for output in outputs]
+                if task_metrics is None:
+                    task_metrics = [ConfusionMatrix(output.shape[1], device) for output in outputs]
+                for task, output in enumerate(outputs):
+                    task_metrics[task].update(output.argmax(dim=1), labels[:, task])
+                self.log_progress(progress, step, total_loss)
+                profiler.step()
+
+        val_loss = round(mean_loss(total_loss, step), 3)
+        metrics = []
+        for name, task_metric in zip(TASKS, task_metrics):
+            all_reduce_sum(task_metric.matrix)
+            accuracy, percision, recall = task_metric.compute()
+            metrics.append((accuracy, percision, recall))
+            self.logger.info(f'\t{name} .. Accuracy = {round(accuracy*100, 2)} % .. Percision = {round(percision*100, 2)} % .. Recall = {round(recall*100, 2)} %')
+
+            if args.evaluate and amp == args.amp and is_main_process():
+                show_metrics(task_metric, name)
+
+        # mean over the heads for the scheduler / tensorboard
+        accuracy, percision, recall = [round(np.mean(metric).item(), 3) for metric in zip(*metrics)]
+        if is_main_process() and not self.worker:
+            print(f'Val loss = {val_loss} .. Accuracy = {accuracy} .. Percision = {percision} .. Recall = {recall}')
         return val_loss, accuracy, percision, recall
 
+def validation_worker(args, model, requests, results):
+    """ process of --async_val: validates the (epoch, state_dict, full) requests, puts (epoch, metrics) in results """
+    # a daemon process cannot have children, its loaders read the validation set in process
+    args = copy.copy(args)
+    args.num_workers, args.persistent_workers = 0, False
+    try:
+        trainer = Trainer(args, worker=True)
+        criterion = trainer.criterion()
+        full_loader = trainer.create_validation_dataloader()
+        loaders = {True: full_loader, False: trainer.create_subsample_dataloader(full_loader) or full_loader}
+        _, augment = trainer.create_augmentations(full_loader.dataset, full_loader.dataset)
+        model.to(trainer.device)
+        for epoch, state, full in iter(requests.get, None):
+            model.load_state_dict(state)
+            results.put((epoch, trainer.validate_fn()(model, criterion, loaders[full], epoch, augment)))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+class AsyncValidator:
+    """ --async_val: a worker process validates the weight snapshots while the training goes on """
+    def __init__(self, args, model):
+        # spawn: no fork of the training process & its threads, train.py is imported again in the worker
+        context = torch.multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = []
+        self.process = context.Process(target=validation_worker, daemon=True,
+                                       args=(args, copy.deepcopy(model).cpu(), self.requests, self.results))
+        self.process.start()
+
+    def submit(self, epoch, model, full=True):
+        """ validation of a CPU copy of the current weights of model """
+        self.requests.put((epoch, to_cpu(model.state_dict()), full))
+        self.pending.append(epoch)
+
+    def is_pending(self, epoch):
+        return epoch in self.pending
+
+    def poll(self, wait=False):
+        """ [(epoch, metrics)] of the finished validations, waits for all the pending ones if wait """
+        done = []
+        while self.pending:
+            try:
+                epoch, metrics = self.results.get(timeout=10) if wait else self.results.get_nowait()
+            except queue.Empty:
+                if wait and self.process.is_alive():
+                    continue
+                if not self.process.is_alive():
+                    raise RuntimeError('the --async_val worker died')
+                break
+            if epoch == 'error':
+                raise RuntimeError(f'--async_val worker failed:\n{metrics}')
+            self.pending.remove(epoch)
+            done.append((epoch, metrics))
+        return done
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def main(argv=None):
+    """ command line: train.py arguments of argv (sys.argv by default) """
+    return Trainer(parse_args(argv)).run()
+
 if __name__ == "__main__":
     main()
-    # total_labels = [0, 1, 2, 0]
-    # total_pred =   [0, 2, 1, 2]
-    # avg = None
-    # avg = 'macro'
-    # percision = precision_score(total_labels, total_pred, average=avg)
-    # recall = recall_score(total_labels, total_pred, average=avg)
-    # accuracy = accuracy_score(total_labels, total_pred)
-    # print(percision, recall, accuracy)
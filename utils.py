@@ -4,11 +4,14 @@ email: amrelsersay@gmail.com
 -----------------------------------------------------------------------------------
 Description: utils functions
 """
+import os
+import json
 import numpy as np
 import seaborn as sn
 import matplotlib.pyplot as plt
 import pandas as pd
 import cv2
+from PIL import Image, ImageOps
 from torchvision.transforms.transforms import ToTensor, ToPILImage, RandomCrop, RandomCrop, Resize
 from torchvision.transforms.transforms import RandomRotation, RandomHorizontalFlip, Compose 
 
@@ -62,6 +65,10 @@ def histogram_equalization(image):
     # return (equalized/255).astype(np.float32)
     return equalized
 
+def pil_histogram_equalization(image):
+    # PIL equalization, as transforms.RandomEqualize(p=1) used for the ImageFolder datasets
+    return np.array(ImageOps.equalize(Image.fromarray(image)))
+
 def normalization(face):
     face = tensor_to_numpy(face)
     # [-1,1] range
@@ -102,15 +109,28 @@ def is_black_image(face):
         return True
     return False
 
-def normalize_dataset_mode_1(image):
-    mean = 0.5077425080522144 
-    std = 0.21187228780099732
-    image = (image - mean) / std
+# statistics sidecar written by dataset_stats.py
+STATS_PATH = 'data/fer2013_train_stats.json'
+_dataset_stats = {}
+
+def load_dataset_stats(path=STATS_PATH):
+    """ (mean, std) in 0-255 range from a dataset_stats.py sidecar, FER2013 train constants if there is none """
+    if path not in _dataset_stats:
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                stats = json.load(f)
+            _dataset_stats[path] = (stats['mean'], stats['std'])
+        else:
+            _dataset_stats[path] = (129.47433955331468, 54.02743338925431)
+    return _dataset_stats[path]
+
+def normalize_dataset_mode_1(image, stats_path=STATS_PATH):
+    mean, std = load_dataset_stats(stats_path)
+    image = (image - mean / 255) / (std / 255)
     return image
 
-def normalize_dataset_mode_255(image):
-    mean = 129.47433955331468 
-    std = 54.02743338925431
+def normalize_dataset_mode_255(image, stats_path=STATS_PATH):
+    mean, std = load_dataset_stats(stats_path)
     image = (image - mean) / std
     return image
 